@@ -6,7 +6,7 @@ Web App将在9000端口监听HTTP请求，并且对首页/进行响应
 """
 import logging
 
-import asyncio, os, json, time
+import asyncio, hmac, os, json, time
 from datetime import datetime
 
 from aiohttp import web
@@ -15,7 +15,10 @@ from jinja2 import Environment, FileSystemLoader
 from config import configs
 
 import orm
-from coroweb import add_routes, add_static
+import ids
+import metrics
+import querylog
+from coroweb import get, add_route, add_routes, add_static, make_etag, is_fresh, validator_headers
 
 # from handlers import cookie2user, COOKIE_NAME
 
@@ -100,6 +103,61 @@ async def logger_factory(app, handler):
     return logger
 
 
+async def routing_factory(app, handler):
+    """
+    middleware,为每个请求创建读写分离的状态，见orm.request_scope()
+    请求中任何一个任务写过数据库后，同一请求的其他任务（包括asyncio.gather()创建的子任务）后续的查询都走主库
+    :param app:
+    :param handler:
+    :return:
+    """
+    async def routing(request):
+        with orm.request_scope():
+            return await handler(request)
+    return routing
+
+
+async def deadline_factory(app, handler):
+    """
+    middleware,给每个请求的数据库查询设置时间预算（configs.deadline秒），见orm.deadline()
+    超时返回504；客户端断开时aiohttp取消处理请求的任务，orm中断正在执行的语句并归还连接
+    :param app:
+    :param handler:
+    :return:
+    """
+    async def deadline(request):
+        seconds = configs.get('deadline', None)
+        if not seconds:
+            return await handler(request)
+        try:
+            with orm.deadline(seconds):
+                return await handler(request)
+        except orm.DeadlineExceeded:
+            logging.warning('Deadline exceeded: %s %s' % (request.method, request.path))
+            raise web.HTTPGatewayTimeout()
+    return deadline
+
+
+def json_default(o):
+    """
+    json.dumps无法直接序列化的对象使用__dict__
+    """
+    return o.__dict__
+
+
+def json_rows(o):
+    """
+    orm.Row是tuple的子类，json.dumps会直接把它序列化成数组、不经过json_default，序列化前转成dict
+    """
+    if isinstance(o, orm.Row):
+        return o._asdict()
+    if isinstance(o, dict):
+        return {k: json_rows(v) for k, v in o.items()}
+    if isinstance(o, (list, tuple)):
+        return [json_rows(v) for v in o]
+    return o
+
+
 async def response_factory(app, handler):
     """
     middleware,把返回值转换为web.Response对象再返回，以保证满足aiohttp的要求
@@ -123,13 +181,36 @@ async def response_factory(app, handler):
     multipart/alternative（HTML邮件的HTML形式和纯文本形式，相同内容使用不同形式表示）
     application/x-www-form-urlencoded（使用HTTP的POST方法提交的表单）
     multipart/form-data（同上，但主要用于表单提交时伴随文件上传的场合）
+
+    GET请求的200响应带上ETag（以及Last-Modified），客户端缓存仍然有效时回答304，见coroweb的条件请求
     """
     async def response(request):
         logging.info('Response handler...')
         # 结果:
         result = await handler(request)
-        # 是web.Response对象，直接返回
-        if isinstance(request, web.StreamResponse):
+        if isinstance(result, web.StreamResponse):
+            return result
+        etag = last_modified = None
+        if isinstance(result, dict) and ('__etag__' in result or '__last_modified__' in result):
+            # URL函数给出了版本，先判断客户端缓存，命中时不渲染
+            version = result.pop('__etag__', None)
+            last_modified = result.pop('__last_modified__', None)
+            if version is not None:
+                etag = make_etag(request, version)
+            if is_fresh(request, etag, last_modified):
+                return web.Response(status=304, headers=validator_headers(etag, last_modified))
+        resp = render(request, result)
+        if request.method not in ('GET', 'HEAD') or resp.status != 200 or not isinstance(resp.body, bytes):
+            return resp
+        if etag is None:
+            etag = make_etag(request, body=resp.body)
+        if is_fresh(request, etag, last_modified):
+            return web.Response(status=304, headers=validator_headers(etag, last_modified))
+        resp.headers.update(validator_headers(etag, last_modified))
+        return resp
+
+    def render(request, result):
+        if isinstance(result, web.StreamResponse):
             return result
         # bytes，为二进制流
         if isinstance(result, bytes):
@@ -152,9 +233,9 @@ async def response_factory(app, handler):
             if template is None:
                 resp = web.Response(
                     body=json.dumps(
-                        result,
+                        json_rows(result),
                         ensure_ascii=False,
-                        default=lambda o: o.__dict__).encode('utf-'))
+                        default=json_default).encode('utf-'))
                 resp.content_type = 'application/json;charset=utf-8'
                 return resp
             else:  # 有模板
@@ -181,6 +262,36 @@ async def response_factory(app, handler):
     return response
 
 
+@get('/metrics')
+async def metrics_handler():
+    """
+    文本格式的运行时指标：连接池等待/占用时间、按SQL模板分组的耗时直方图和行数
+    """
+    resp = web.Response(body=metrics.registry.render().encode('utf-8'))
+    resp.content_type = 'text/plain;version=0.0.4;charset=utf-8'
+    return resp
+
+
+def is_admin(request):
+    """
+    :return: ``bool`` 请求头X-Admin-Token与configs.admin_token相同。反向代理后request.remote总是代理的地址，不能用来判断
+    """
+    token = configs.get('admin_token', None)
+    return bool(token) and hmac.compare_digest(request.headers.get('X-Admin-Token', ''), token)
+
+
+@get('/admin/queries')
+async def slow_queries_handler(request):
+    """
+    环形缓冲区中的慢查询（参数已脱敏），最近的在前。没有配置configs.admin_token时关闭
+    """
+    if not configs.get('admin_token', None):
+        return web.HTTPNotFound()
+    if not is_admin(request):
+        return web.HTTPForbidden()
+    return dict(slow=querylog.querylog.slow, queries=querylog.querylog.dump())
+
+
 def timestamp2time(ts):
     local_time = time.localtime(ts)
     dt = time.strftime("%Y-%m-%d %H:%M:%S", local_time)
@@ -193,11 +304,19 @@ async def init(loop):
     :param loop:
     :return:
     """
+    ids.configure(**configs.ids)
+    querylog.configure(**configs.querylog)
+    querylog.install()
     await orm.create_pool(loop=loop, **configs.db)
-    app = web.Application(loop=loop, middlewares=[logger_factory, response_factory])
+    # 开始监听前预先打开连接，并定期检查空闲连接
+    await orm.warm_up(configs.db.get('warm_up', 0))
+    orm.start_keepalive(configs.db.get('keepalive', 0))
+    app = web.Application(loop=loop, middlewares=[logger_factory, routing_factory, deadline_factory, response_factory])
     init_jinja2(app, filters=dict(datetime=datetime_filter))
     # app.router.add_route('GET', '/', index)
     add_routes(app, 'handlers')
+    add_route(app, metrics_handler)
+    add_route(app, slow_queries_handler)
     add_static(app)
     srv = await loop.create_server(app.make_handler(), '127.0.0.1', 9000)
     logging.info('server started at http://127.0.0.1:9000...')
@@ -208,5 +327,9 @@ if __name__ == '__main__':
     # print(timestamp2time(1515685403.75598))
     event_loop = asyncio.get_event_loop()
     event_loop.run_until_complete(init(event_loop))
-    event_loop.run_forever()
+    try:
+        event_loop.run_forever()
+    except KeyboardInterrupt:
+        # 写完所有模型的延迟写入队列、关闭连接池再退出
+        event_loop.run_until_complete(orm.close_pool())
 
@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+
+"""
+数据库后端
+
+orm只通过后端对象访问数据库：create_pool()创建连接池，cursor()按类型创建游标，translate()转换占位符。
+连接池和连接的接口与aiomysql一致（acquire()/release()、begin()/commit()/rollback()、cursor()、execute()/fetchall()等），
+所以MySQL后端直接使用aiomysql；SQLite后端在线程中执行sqlite3，不需要MySQL也能跑通handlers、coroweb、orm的完整请求路径，
+用来在CI上做集成测试和压测。
+
+在configs.db中用backend选择后端：
+
+configs = {
+    'db': {
+        'backend': 'sqlite',
+        'db': '/tmp/awesome.db'
+    }
+}
+"""
+import asyncio, functools, logging, sqlite3, time
+from concurrent.futures import ThreadPoolExecutor
+
+# 游标类型
+DICT = 'dict'  # 每行是dict
+STREAM = 'stream'  # 每行是dict，结果集不缓存在客户端，用fetchmany()分批读取
+TUPLE = 'tuple'  # 每行是按SELECT字段顺序排列的tuple，驱动不需要为每行构造dict
+
+
+@functools.lru_cache(maxsize=1024)
+def translate(sql):
+    """
+    SQL语句的占位符是?，而MySQL的占位符是%s。转换结果按原SQL缓存，同一条语句只做一次字符串替换，
+    ModelMetaclass在创建Model类时就预先转换好了__select__、__insert__、__update__和__delete__。
+    :param sql: ``str`` 使用?占位符的SQL语句
+    :return: ``str`` 使用%s占位符的SQL语句
+    """
+    return sql.replace('?', '%s')
+
+
+class Backend(object):
+    """
+    后端的基类
+    """
+    name = None
+    # CREATE TABLE语句后面的表选项
+    table_options = ''
+    # 是否支持从information_schema读取估计的行数
+    approximate_count = False
+    # 查询表上已有索引的SQL，参数为表名；每行包括INDEX_NAME、COLUMN_NAME、NON_UNIQUE，按索引名和字段顺序排列
+    index_sql = None
+    # SELECT ... FOR UPDATE的锁定子句，upsert_many()用它锁定已有的行
+    lock_clause = ''
+    # 单行upsert的影响行数能否区分插入（1）和更新
+    upsert_rowcount = False
+
+    async def create_pool(self, loop, **kwargs):
+        raise NotImplementedError
+
+    def limit_time(self, sql, timeout):
+        """
+        :param sql: ``str`` translate()之后的SELECT语句
+        :param timeout: ``float`` 剩余的秒数
+        :return: ``str`` 由服务器限制执行时间的语句，不支持时原样返回
+        """
+        return sql
+
+    def interrupt(self, conn):
+        """
+        中断连接上正在执行的语句。由orm在语句超时或者被取消时调用，之后连接照常交还连接池
+        :param conn: 连接池中取出的连接
+        """
+        pass
+
+    def upsert(self, insert, primary_key, columns):
+        """
+        :param insert: ``str`` INSERT语句
+        :param primary_key: ``str`` 主键
+        :param columns: ``tuple`` 主键冲突时更新的字段
+        :return: ``str`` 主键冲突时改为更新这些字段的INSERT语句
+        """
+        raise NotImplementedError
+
+    def cursor(self, conn, kind=DICT):
+        """
+        :param conn: 连接池中取出的连接
+        :param kind: 游标类型，DICT、STREAM或TUPLE
+        :return: 用async with使用的游标
+        """
+        raise NotImplementedError
+
+    def translate(self, sql):
+        """
+        :param sql: ``str`` 使用?占位符的SQL语句
+        :return: ``str`` 驱动使用的SQL语句
+        """
+        return sql
+
+
+class MySQLBackend(Backend):
+    name = 'mysql'
+    table_options = 'engine=innodb default charset=utf8'
+    approximate_count = True
+    index_sql = ('select `INDEX_NAME`, `COLUMN_NAME`, `NON_UNIQUE` from `information_schema`.`STATISTICS` '
+                 'where `TABLE_SCHEMA`=database() and `TABLE_NAME`=? order by `INDEX_NAME`, `SEQ_IN_INDEX`')
+    lock_clause = ' for update'
+    # ON DUPLICATE KEY UPDATE插入时影响1行，更新时影响2行，值没有变化时为0行
+    upsert_rowcount = True
+
+    def __init__(self):
+        import aiomysql
+        self.aiomysql = aiomysql
+        # 还没有结束的KILL QUERY任务
+        self._kills = set()
+        self.cursors = {DICT: aiomysql.DictCursor, STREAM: aiomysql.SSDictCursor, TUPLE: aiomysql.Cursor}
+
+    async def create_pool(self, loop, **kwargs):
+        return await self.aiomysql.create_pool(
+            host=kwargs.get('host', 'localhost'),
+            port=kwargs.get('port', 3306),
+            user=kwargs.get('user'),
+            password=kwargs['password'],
+            db=kwargs['db'],
+            charset=kwargs.get('charset', 'utf8'),
+            autocommit=kwargs.get('autocommit', True),
+            maxsize=kwargs.get('maxsize', 10),
+            minsize=kwargs.get('minsize', 1),
+            # 连接的最长使用时间（秒），到期的连接在取出时关闭重建，-1表示不限制
+            pool_recycle=kwargs.get('pool_recycle', -1),
+            loop=loop
+        )
+
+    def cursor(self, conn, kind=DICT):
+        return conn.cursor(self.cursors[kind])
+
+    def translate(self, sql):
+        return translate(sql)
+
+    def limit_time(self, sql, timeout):
+        # MySQL 5.7.8以上只对SELECT语句支持MAX_EXECUTION_TIME，单位毫秒
+        if sql[:7].lower() != 'select ':
+            return sql
+        return 'select /*+ MAX_EXECUTION_TIME(%d) */ %s' % (max(1, int(timeout * 1000)), sql[7:])
+
+    def interrupt(self, conn):
+        # 连接可能停在读写协议的中间，不能再用：关闭它（连接池会丢弃已关闭的连接），
+        # 再用另一个连接KILL QUERY，服务器上的语句不会一直执行到结束
+        if conn.closed:
+            return
+        thread_id = conn.thread_id()
+        conn.close()
+        task = asyncio.get_event_loop().create_task(self.kill_query(conn, thread_id))
+        self._kills.add(task)
+        task.add_done_callback(self._kills.discard)
+
+    async def kill_query(self, conn, thread_id):
+        """
+        :param conn: 被中断的连接，用它的地址和账号连接同一台服务器
+        :param thread_id: ``int`` 被中断的连接在服务器上的线程id
+        """
+        try:
+            killer = await self.aiomysql.connect(host=conn.host, port=conn.port, user=conn.user,
+                                                 password=conn._password, db=conn.db)
+            try:
+                async with killer.cursor() as cur:
+                    await cur.execute('kill query %d' % thread_id)
+            finally:
+                killer.close()
+        except Exception as e:
+            logging.warning('failed to kill query on thread %s: %s' % (thread_id, e))
+
+    def upsert(self, insert, primary_key, columns):
+        return '%s on duplicate key update %s' % (insert, ', '.join('`%s`=values(`%s`)' % (c, c) for c in columns))
+
+
+def dict_factory(cursor, row):
+    return {d[0]: v for d, v in zip(cursor.description, row)}
+
+
+class SQLiteCursor(object):
+    """
+    sqlite3游标的异步包装，所有操作都在连接自己的线程中执行
+    """
+
+    def __init__(self, conn, kind=DICT):
+        self._conn = conn
+        self._kind = kind
+        self._cur = None
+        self.rowcount = -1
+
+    async def __aenter__(self):
+        self._cur = await self._conn.run(self._conn.raw.cursor)
+        if self._kind in (DICT, STREAM):
+            self._cur.row_factory = dict_factory
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._conn.run(self._cur.close)
+        return False
+
+    async def execute(self, sql, args=None):
+        await self._conn.run(self._cur.execute, sql, tuple(args or ()))
+        self.rowcount = self._cur.rowcount
+
+    async def executemany(self, sql, seq_of_args):
+        await self._conn.run(self._cur.executemany, sql, [tuple(a) for a in seq_of_args])
+        self.rowcount = self._cur.rowcount
+
+    async def fetchone(self):
+        return await self._conn.run(self._cur.fetchone)
+
+    async def fetchmany(self, size):
+        return await self._conn.run(self._cur.fetchmany, size)
+
+    async def fetchall(self):
+        return await self._conn.run(self._cur.fetchall)
+
+
+class SQLiteConnection(object):
+    """
+    一个sqlite3连接和专用的单线程执行器，同一个连接上的操作按顺序在同一个线程中执行
+    """
+
+    def __init__(self, raw, executor):
+        self.raw = raw
+        self._executor = executor
+        self.created = time.monotonic()
+        self.closed = False
+
+    def run(self, fn, *args):
+        return asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def cursor(self, kind=DICT):
+        return SQLiteCursor(self, kind)
+
+    async def begin(self):
+        await self.run(self.raw.execute, 'begin')
+
+    async def commit(self):
+        if self.raw.in_transaction:
+            await self.run(self.raw.execute, 'commit')
+
+    async def rollback(self):
+        if self.raw.in_transaction:
+            await self.run(self.raw.execute, 'rollback')
+
+    async def ping(self, reconnect=True):
+        await self.run(self.raw.execute, 'select 1')
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._executor.submit(self.raw.close)
+        self._executor.shutdown(wait=False)
+
+
+class SQLitePool(object):
+    """
+    SQLite连接池，接口与aiomysql.Pool相同
+    """
+
+    def __init__(self, database, minsize, maxsize, timeout, recycle=-1):
+        self.database = database
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.recycle = recycle
+        self._free = asyncio.Queue()
+        self._size = 0
+        self._closed = False
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def freesize(self):
+        return self._free.qsize()
+
+    async def fill(self):
+        while self._size < self.minsize:
+            self._size += 1
+            try:
+                self._free.put_nowait(await self._connect())
+            except Exception:
+                self._size -= 1
+                raise
+
+    def _open(self):
+        raw = sqlite3.connect(self.database, timeout=self.timeout, isolation_level=None,
+                              check_same_thread=False, uri=self.database.startswith('file:'))
+        if not self.database.startswith('file:'):
+            # 文件数据库使用WAL，读写可以并发
+            raw.execute('pragma journal_mode=wal')
+        return raw
+
+    async def _connect(self):
+        executor = ThreadPoolExecutor(max_workers=1)
+        raw = await asyncio.get_running_loop().run_in_executor(executor, self._open)
+        return SQLiteConnection(raw, executor)
+
+    async def acquire(self):
+        if self._closed:
+            raise RuntimeError('Cannot acquire connection after closing pool')
+        if self._free.empty() and self._size < self.maxsize:
+            self._size += 1
+            try:
+                return await self._connect()
+            except Exception:
+                self._size -= 1
+                raise
+        conn = await self._free.get()
+        if self.recycle > 0 and time.monotonic() - conn.created > self.recycle:
+            conn.close()
+            try:
+                conn = await self._connect()
+            except Exception:
+                self._size -= 1
+                raise
+        return conn
+
+    def release(self, conn):
+        if self._closed or conn.closed:
+            self._size -= 1
+            conn.close()
+            return
+        self._free.put_nowait(conn)
+
+    def close(self):
+        self._closed = True
+        while not self._free.empty():
+            self._free.get_nowait().close()
+            self._size -= 1
+
+    async def wait_closed(self):
+        pass
+
+
+class SQLiteBackend(Backend):
+    """
+    SQLite后端。db是数据库文件的路径；为':memory:'时使用共享缓存的内存数据库，此时连接池只有一个连接，
+    因为共享缓存的多个连接并发读写同一个表时会直接报错，而不是等待。
+    SQLite接受`反引号`、limit ?, ?和Model生成的DDL中的字段类型，orm生成的SQL不需要改写。
+    """
+    name = 'sqlite'
+    # pragma的表值函数需要SQLite 3.16以上
+    index_sql = ('select il.`name` as `INDEX_NAME`, ii.`name` as `COLUMN_NAME`, not il.`unique` as `NON_UNIQUE` '
+                 'from pragma_index_list(?) il join pragma_index_info(il.`name`) ii order by il.`name`, ii.`seqno`')
+
+    async def create_pool(self, loop, **kwargs):
+        database = kwargs.get('db', ':memory:')
+        maxsize = kwargs.get('maxsize', 10)
+        if database == ':memory:':
+            database = 'file:awesome?mode=memory&cache=shared'
+            maxsize = 1
+        logging.info('create sqlite connection pool: %s' % database)
+        pool = SQLitePool(database, min(kwargs.get('minsize', 1), maxsize), maxsize, kwargs.get('timeout', 30),
+                          kwargs.get('pool_recycle', -1))
+        await pool.fill()
+        return pool
+
+    def cursor(self, conn, kind=DICT):
+        return conn.cursor(kind)
+
+    def interrupt(self, conn):
+        # sqlite3的interrupt()可以从其他线程调用，正在执行的语句以OperationalError结束，连接可以继续使用
+        conn.raw.interrupt()
+
+    def upsert(self, insert, primary_key, columns):
+        # ON CONFLICT需要SQLite 3.24以上
+        return '%s on conflict(`%s`) do update set %s' % (
+            insert, primary_key, ', '.join('`%s`=excluded.`%s`' % (c, c) for c in columns))
+
+
+BACKENDS = dict(mysql=MySQLBackend, sqlite=SQLiteBackend)
+
+
+def get_backend(name):
+    """
+    :param name: ``str`` 后端名称，mysql或sqlite
+    :return: ``Backend``
+    """
+    if name not in BACKENDS:
+        raise ValueError('Unknown database backend: %s' % name)
+    return BACKENDS[name]()
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+"""
+RequestHandler取参数的微基准测试。
+
+用一个假的request对象直接调用RequestHandler，不经过aiohttp的路由和网络，只比较从request中取参数、调用URL函数的开销：
+LegacyRequestHandler是改造前每次请求都重新判断参数种类的实现，RequestHandler使用注册时生成的compile_binder()。
+运行：python bench_coroweb.py
+"""
+import asyncio, logging, time
+from urllib import parse
+
+from aiohttp import web
+
+from coroweb import get, post, RequestHandler, has_request_arg, has_var_kw_arg, has_named_kw_args, \
+    get_named_kw_args, get_required_kw_args
+
+
+class FakeRequest(object):
+    """ 只有RequestHandler用到的属性 """
+
+    def __init__(self, method='GET', query_string='', match_info=None, content_type='', body=None):
+        self.method = method
+        self.query_string = query_string
+        self.match_info = match_info or {}
+        self.content_type = content_type
+        self._body = body
+
+    async def json(self):
+        return dict(self._body)
+
+    async def post(self):
+        return dict(self._body)
+
+
+class LegacyRequestHandler(object):
+    """ 改造前的RequestHandler """
+
+    def __init__(self, app, fn):
+        self._app = app
+        self._func = fn
+        self._has_request_arg = has_request_arg(fn)
+        self._has_var_kw_arg = has_var_kw_arg(fn)
+        self._has_named_kw_args = has_named_kw_args(fn)
+        self._named_kw_args = get_named_kw_args(fn)
+        self._required_kw_args = get_required_kw_args(fn)
+
+    async def __call__(self, request):
+        kwargs = None
+        logging.debug('kwargs = None')
+        if self._has_named_kw_args or self._has_var_kw_arg or self._required_kw_args:
+            if request.method == 'POST':
+                logging.debug('POST')
+                content_type = request.content_type.lower()
+                if not content_type:
+                    return web.HTTPBadRequest(text='Missing Content-Type.')
+                if content_type.startswith('application/json'):
+                    params = await request.json()
+                    if not isinstance(params, dict):
+                        return web.HTTPBadRequest(text='JSON body must be  dict object.')
+                    kwargs = params
+                elif content_type.startswith('application/x-www-form-urlencoded') \
+                        or content_type.startswith('multipart/form-data'):
+                    params = await request.post()
+                    kwargs = dict(**params)
+                else:
+                    return web.HTTPBadRequest(text='Unsupported Content-Type: %s' % request.content_type)
+            elif request.method == 'GET':
+                logging.debug('GET')
+                query_string = request.query_string
+                if query_string:
+                    kwargs = dict()
+                    for k, v in parse.parse_qs(query_string, True).items():
+                        kwargs[k] = v[0]
+        if kwargs is None:
+            logging.debug('kwargs is None')
+            kwargs = dict(**request.match_info)
+        else:
+            logging.debug('kwargs is %s' % request)
+            if not self._has_var_kw_arg and self._has_named_kw_args:
+                copy = dict()
+                for name in self._named_kw_args:
+                    if name in kwargs:
+                        copy[name] = kwargs[name]
+                kwargs = copy
+            for k, v in request.match_info.items():
+                if k in kwargs:
+                    logging.warning('Duplicate arg name in named arg and kw args: %s' % k)
+                kwargs[k] = v
+        if self._has_request_arg:
+            kwargs['request'] = request
+        if self._required_kw_args:
+            for name in self._required_kw_args:
+                if name not in kwargs:
+                    return web.HTTPBadRequest(text='Missing argument: %s' % name)
+        logging.info('call with args: %s' % str(kwargs))
+        try:
+            r = self._func(**kwargs)
+            if asyncio.iscoroutine(r):
+                r = await r
+            return r
+        except Exception as e:
+            return dict(error=e)
+
+
+@get('/')
+async def index(request):
+    return dict(__template__='blogs.html')
+
+
+@get('/blog/{id}')
+async def blog(id):
+    return dict(id=id)
+
+
+@get('/api/blogs')
+async def api_blogs(*, page='1', size='10'):
+    return dict(page=page, size=size)
+
+
+@post('/api/blogs/{id}/comments')
+async def api_create_comment(id, request, *, content):
+    return dict(id=id, content=content)
+
+
+@post('/api/users')
+async def api_register_user(*, email, name, passwd):
+    return dict(email=email, name=name)
+
+
+CASES = (
+    ('GET / (request only)', index, FakeRequest()),
+    ('GET /blog/{id} (path arg)', blog, FakeRequest(match_info={'id': '42'})),
+    ('GET /api/blogs?page=2 (query)', api_blogs, FakeRequest(query_string='page=2&size=20')),
+    ('POST comment (JSON body)', api_create_comment, FakeRequest(
+        'POST', match_info={'id': '42'}, content_type='application/json', body={'content': 'hello'})),
+    ('POST register (form body)', api_register_user, FakeRequest(
+        'POST', content_type='application/x-www-form-urlencoded',
+        body={'email': 'a@example.com', 'name': 'a', 'passwd': 'x', 'extra': '1'})),
+)
+
+
+def bench(handler, request, number=20000):
+    """
+    :return: ``float`` 每秒处理的请求数
+    """
+    async def run():
+        for _ in range(number):
+            await handler(request)
+
+    loop = asyncio.new_event_loop()
+    try:
+        start = time.perf_counter()
+        loop.run_until_complete(run())
+        return number / (time.perf_counter() - start)
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    # 和app.py一样，INFO级别的日志是打开的，输出丢弃
+    logging.basicConfig(level=logging.INFO, handlers=[logging.NullHandler()])
+    print('%-32s %12s %12s' % ('handler', 'legacy req/s', 'binder req/s'))
+    for name, fn, request in CASES:
+        legacy = bench(LegacyRequestHandler(None, fn), request)
+        compiled = bench(RequestHandler(None, fn), request)
+        print('%-32s %12.0f %12.0f  x%.2f' % (name, legacy, compiled, compiled / legacy))
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+
+"""
+ORM热路径的微基准测试。
+
+bench_findall()和bench_rows()不连接数据库，用一个直接返回结果的假select()代替数据库往返，只比较ORM自身构造SQL、
+绑定参数和生成实例的开销；bench_sqlite()在SQLite后端上生成数据，测量完整的查询路径。
+运行：python bench_orm.py [sqlite数据库文件]
+"""
+import asyncio, io, os, sys, tempfile, time, timeit, tracemalloc
+
+import ids
+import orm
+from backends import TUPLE
+from models import Blog, User, Comment
+
+
+ROWS = [dict(id='1', user_id='u', user_name='n', user_image='i', name='b', summary='s', content='c', created_at=1.0)]
+TUPLES = [tuple(r.values()) for r in ROWS]
+
+# 原select()每次都要print一次转换后的SQL，这里打印到内存中，避免刷屏
+_sink = io.StringIO()
+
+
+async def fake_select(sql, args, size=None, kind=None):
+    orm.translate(sql)
+    return TUPLES if kind == TUPLE else ROWS
+
+
+async def legacy_select(sql, args, size=None):
+    print(sql.replace('?', '%s'), file=_sink)
+    sql.replace('?', '%s')  # cur.execute()前的第二次替换
+    return ROWS
+
+
+async def legacy_findall(cls, where=None, args=None, **kw):
+    """ 改造前的Model.findall，每次调用都重新拼接SQL """
+    sql = [cls.__select__]
+    if where:
+        sql.append('where')
+        sql.append(where)
+    if args is None:
+        args = []
+    orderby = kw.get('orderBy', None)
+    if orderby is not None:
+        sql.append('order by')
+        sql.append(orderby)
+    limit = kw.get('limit', None)
+    if limit is not None:
+        sql.append('limit')
+        if isinstance(limit, int):
+            sql.append('?')
+            args.append(limit)
+        elif isinstance(limit, tuple) and len(limit) == 2:
+            sql.append('?, ?')
+            args.extend(limit)
+        else:
+            raise ValueError('Invalid limit value: %s' % str(limit))
+    rs = await legacy_select(' '.join(sql), args)
+    return [cls(**r) for r in rs]
+
+
+def bench(name, factory, number=20000):
+    """
+    运行factory()返回的协程number次，打印每次调用的平均耗时
+    :param name: ``str`` 测试名称
+    :param factory: 返回协程的函数
+    :param number: ``int`` 运行次数
+    :return: ``float`` 每次调用的平均耗时（微秒）
+    """
+    async def run():
+        for _ in range(number):
+            await factory()
+
+    loop = asyncio.new_event_loop()
+    try:
+        start = time.perf_counter()
+        loop.run_until_complete(run())
+        elapsed = time.perf_counter() - start
+    finally:
+        loop.close()
+    per_call = elapsed / number * 1e6
+    print('%-40s %8.2f us/call' % (name, per_call))
+    return per_call
+
+
+def bench_findall():
+    """
+    比较改造前的findall、现在的findall、查询构造器和prepare()编译好的查询。
+    查询构造器每次调用都要创建Condition和Query对象，比直接传SQL片段的findall慢约2us；
+    编译好的查询每次只绑定参数，不比findall慢
+    """
+    select, orm.select = orm.select, fake_select
+    try:
+        _bench_findall()
+    finally:
+        orm.select = select
+
+
+def _bench_findall():
+    bench('legacy findall', lambda: legacy_findall(
+        Blog, '`user_id`=?', ['u'], orderBy='`created_at` desc', limit=(0, 10)))
+    bench('findall (compiled statement cache)', lambda: Blog.findall(
+        '`user_id`=?', ['u'], orderBy='`created_at` desc', limit=(0, 10)))
+    bench('query builder', lambda: Blog.where(Blog.user_id == 'u').order_by(
+        Blog.created_at.desc()).limit(0, 10).all())
+    prepared = Blog.where(Blog.user_id == '').order_by(Blog.created_at.desc()).limit(0, 10).prepare()
+    bench('query builder, prepare()', lambda: prepared.all('u', 0, 10))
+
+
+def make_rows(n):
+    return [dict(id='%015d' % i, user_id='u%d' % (i % 100), user_name='name', user_image='image', name='blog %d' % i,
+                 summary='summary %d' % i, content='content', created_at=float(i)) for i in range(n)]
+
+
+def measure_memory(factory, rows):
+    """
+    :return: ``float`` 每行实例占用的字节数
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = [factory(r) for r in rows]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return (after - before) / len(rows)
+
+
+def bench_rows(n=1000):
+    """ 比较Model实例和紧凑行Row的内存、构造和属性访问速度 """
+    rows = make_rows(n)
+    model = lambda r: Blog(**r)
+    row = Blog.__row__
+    for name, factory in (('Model', model), ('Row (compact=True)', row)):
+        instances = [factory(r) for r in rows]
+        build = min(timeit.repeat(lambda: [factory(r) for r in rows], number=20, repeat=3)) / 20 / n * 1e6
+        access = min(timeit.repeat(lambda: [(b.name, b.summary, b.created_at) for b in instances],
+                                   number=20, repeat=3)) / 20 / n * 1e6
+        print('%-20s %8.1f bytes/row %8.2f us/row build %8.2f us/row access(3 attrs)'
+              % (name, measure_memory(factory, rows), build, access))
+
+
+def bench_hydration(n=10000):
+    """
+    比较由查询结果生成n个实例的每行耗时。DictCursor路径包括驱动为每行构造dict的开销（按aiomysql的做法用dict(zip())模拟），
+    TUPLE游标路径直接按字段顺序填进实例
+    """
+    rows = make_rows(n)
+    names = Blog.__names__
+    tuples = [tuple(r[k] for k in names) for r in rows]
+    cases = (
+        ('DictCursor + cls(**r) (legacy)', lambda: [Blog(**dict(zip(names, r))) for r in tuples]),
+        ('DictCursor + from_rows()', lambda: Blog.from_rows([dict(zip(names, r)) for r in tuples])),
+        ('tuple cursor + from_tuples()', lambda: Blog.from_tuples(tuples)),
+        ('tuple cursor + Row.maker() (compact)', lambda: list(map(Blog.__row__.maker(names), tuples))),
+    )
+    for name, fn in cases:
+        per_row = min(timeit.repeat(fn, number=5, repeat=3)) / 5 / n * 1e6
+        print('%-40s %8.2f us/row (%d rows)' % (name, per_row, n))
+
+
+async def seed(blogs, comments_per_blog):
+    users = [User(email='user%d@example.com' % i, passwd='x', name='user %d' % i, image='about:blank')
+             for i in range(100)]
+    await User.save_many(users)
+    for start in range(0, blogs, 1000):
+        batch = [Blog(user_id=users[i % 100].id, user_name=users[i % 100].name, user_image='about:blank',
+                      name='blog %d' % i, summary='summary ' * 20, content='content ' * 500, created_at=float(i))
+                 for i in range(start, min(start + 1000, blogs))]
+        await Blog.save_many(batch)
+        await Comment.save_many([Comment(blog_id=b.id, user_id=b.user_id, user_name=b.user_name,
+                                         user_image='about:blank', content='comment ' * 20, created_at=b.created_at)
+                                 for b in batch for _ in range(comments_per_blog)])
+
+
+def bench_sqlite(path=None, blogs=10000, comments_per_blog=5):
+    """
+    在SQLite后端上生成blogs篇日志和相应的用户、评论，然后测量常用查询的完整路径
+    :param path: ``str`` 数据库文件，None时使用临时文件
+    """
+    path = path or os.path.join(tempfile.mkdtemp(), 'bench.db')
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    async def setup():
+        await orm.create_pool(loop, backend='sqlite', db=path)
+        await orm.create_tables(User, Blog, Comment)
+        if not await Blog.findNumber('count(id)'):
+            start = time.perf_counter()
+            await seed(blogs, comments_per_blog)
+            print('seeded %d blogs into %s in %.1fs' % (blogs, path, time.perf_counter() - start))
+
+    loop.run_until_complete(setup())
+    ids = [b.id for b in loop.run_until_complete(Blog.findall(columns=[], limit=100))]
+    loop.close()
+    number = 200
+    bench('sqlite findall page 1 (10 rows)', lambda: Blog.findall(orderBy='created_at desc', limit=(0, 10)), number)
+    bench('sqlite findall deep page (offset 9000)', lambda: Blog.findall(
+        orderBy='created_at desc', limit=(9000, 10)), number)
+    bench('sqlite find', lambda: Blog.find(ids[0]), number)
+    bench('sqlite 100 concurrent find', lambda: asyncio.gather(*[Blog.find(i) for i in ids]), number // 10)
+    bench('sqlite findNumber', lambda: Blog.findNumber('count(id)'), number)
+    bench('sqlite findall 10k rows', lambda: Blog.findall(limit=10000), 10)
+    bench('sqlite findall 10k rows (compact)', lambda: Blog.findall(limit=10000, compact=True), 10)
+
+
+def bench_ids(rows=20000, blogs=500):
+    """
+    比较各种主键生成方式：生成速度，以及在SQLite上插入rows条评论的速度和主键索引、blog_id外键索引的大小
+    """
+    for mode in ('legacy', 'compat', 'snowflake'):
+        next_id = ids.configure(mode, worker_id=1)
+        per_id = min(timeit.repeat(next_id, number=10000, repeat=3)) / 10000 * 1e6
+        blog_ids = [next_id() for _ in range(blogs)]
+        comments = [Comment(id=next_id(), blog_id=blog_ids[i % blogs], user_id=blog_ids[i % 7], user_name='name',
+                            user_image='about:blank', content='comment', created_at=float(i)) for i in range(rows)]
+        path = os.path.join(tempfile.mkdtemp(), 'ids.db')
+        loop = asyncio.new_event_loop()
+
+        async def run():
+            await orm.create_pool(loop, backend='sqlite', db=path)
+            await orm.create_tables(Comment)
+            start = time.perf_counter()
+            await Comment.save_many(comments, batch_size=500)
+            elapsed = time.perf_counter() - start
+            sizes = {r['name']: r['size'] for r in await orm.select(
+                'select `name`, sum(`pgsize`) as `size` from dbstat group by `name`', ())}
+            await orm.close_pool()
+            return elapsed, sizes
+
+        try:
+            elapsed, sizes = loop.run_until_complete(run())
+        finally:
+            loop.close()
+        pk = sum(v for k, v in sizes.items() if k.startswith('sqlite_autoindex_comments'))
+        fk = sizes.get('idx_comments_blog_id_created_at', 0)
+        print('%-10s %2d chars %6.2f us/id %8.0f rows/s insert  pk index %6.1f KB  blog_id index %6.1f KB'
+              % (mode, len(blog_ids[0]), per_id, rows / elapsed, pk / 1024, fk / 1024))
+    ids.configure()
+
+
+if __name__ == '__main__':
+    bench_findall()
+    bench_rows()
+    bench_hydration()
+    bench_ids()
+    bench_sqlite(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -15,12 +15,43 @@ Web App可以通过读取不同的配置文件来获得正确的配置。
 # config_default.py
 configs = {
     'db': {
+        # 数据库后端：mysql，或者用于本地测试和压测的sqlite（db为数据库文件路径），见backends.py
+        'backend': 'mysql',
         'host': '127.0.0.1',
         'port': 3306,
         'user': 'www-data',
         'password': 'www-data',
-        'db': 'awesome'
+        'db': 'awesome',
+        'maxsize': 10,
+        # 启动时预先打开的连接数
+        'warm_up': 5,
+        # 每隔多少秒ping一次空闲连接，0表示不检查
+        'keepalive': 30,
+        # 连接的最长使用时间（秒），应小于MySQL的wait_timeout，-1表示不限制
+        'pool_recycle': 3600,
+        # 只读副本，例如[{'host': '10.0.0.2'}, {'host': '10.0.0.3'}]，没有给出的参数沿用主库的配置
+        'replicas': [],
+        # 一个请求写过数据库后，后续查询都走主库
+        'read_your_writes': True,
+        # 副本最多落后主库的秒数，写表后这段时间内从副本读到的计数不会一直缓存
+        'replica_lag': 1
     },
+    # 主键的生成方式，见ids.py：compat兼容已有的varchar(50)主键，snowflake生成13个字符的主键，legacy为原来的方式；
+    # compat和snowflake要求每个进程配置不同的worker_id（0~1023），None表示读取环境变量WORKER_ID，都没有时无法启动
+    'ids': {
+        'mode': 'legacy',
+        'worker_id': None
+    },
+    # 慢查询日志，见querylog.py：超过slow秒的语句记入环形缓冲区（最多capacity条），其余语句按sample的比例输出日志
+    'querylog': {
+        'slow': 0.1,
+        'sample': 0.0,
+        'capacity': 200
+    },
+    # /admin/下的管理接口要求请求头X-Admin-Token等于这个值，None时关闭这些接口；在config_override.py中设置
+    'admin_token': None,
+    # 每个请求中数据库查询的时间预算（秒），超时返回504，0表示不限制
+    'deadline': 10,
     'session': {
         'secret': 'AwEsOmE'
     }
@@ -3,12 +3,14 @@
 """
 在正式开始Web开发前，我们需要编写一个Web框架。
 """
-import functools, inspect, os
+import functools, hashlib, inspect, os
+from email.utils import formatdate
 from aiohttp import web
 from urllib import parse
+
+from orm import DeadlineExceeded
 # import urllib.request
 import logging
-import asyncio
 
 
 # from apis import APIERROR
@@ -227,11 +229,8 @@ class RequestHandler(object):
         """
         self._app = app
         self._func = fn
-        self._has_request_arg = has_request_arg(fn)
-        self._has_var_kw_arg = has_var_kw_arg(fn)
-        self._has_named_kw_args = has_named_kw_args(fn)
-        self._named_kw_args = get_named_kw_args(fn)
-        self._required_kw_args = get_required_kw_args(fn)
+        # 参数的解析方式只由URL函数的签名和请求方式决定，注册时生成一次，见compile_binder()
+        self._bind = compile_binder(fn, getattr(fn, '__method__', None))
 
     async def __call__(self, request):
         """
@@ -243,94 +242,213 @@ class RequestHandler(object):
         3.如果为GET方法，根据HTTP请求的query_string字段（用request.query_string获取）
         4.将获取的参数经处理，使其完全符合视图url函数接收的参数形式
         5.调用视图url函数，返回执行结果
-
-        # 3.如果kw为空（说明request无请求内容），则将match_info列表里的资源映射给kw；若不为空，把命名关键词参数内容给kw
-        # 4.完善_has_request_arg和_required_kw_args属性
         :param request:
         :return:
         """
-        # 1.定义kw，用于保存参数
-        kwargs = None
-        logging.debug('kwargs = None')
-        # 2.判断url函数是否存在关键词参数，如果存在根据POST或者GET方法将request请求内容保存到kwargs
-        if self._has_named_kw_args or self._has_var_kw_arg or self._required_kw_args:
-            if request.method == 'POST':
-                logging.debug('POST')
-                content_type = request.content_type.lower()  # 小写，便于检查
-                if not content_type:  # 如果content_type不存在，返回400错误以及'Missing Content-Type.'
-                    # def __init__(self, *, headers=None, reason=None, body=None, text=None, content_type=None):
-                    return web.HTTPBadRequest(text='Missing Content-Type.')
-                # content-type is application/json
-                if content_type.startswith('application/json'):
-                    # json格式数据
-                    params = await request.json()  # 解析body字段的json数据
-                    if not isinstance(params, dict):  # 如果request.json()返回的不是dict对象，返回400错误以及提示语
-                        return web.HTTPBadRequest(text='JSON body must be  dict object.')
-                    kwargs = params
-                elif content_type.startswith('application/x-www-form-urlencoded') \
-                        or content_type.startswith('multipart/form-data'):  # form表单请求的编码形式
-                    params = await request.post()  # 返回post的内容中解析后的数据。dict-like对象。
-                    kwargs = dict(**params)  # 组成dict，统一kw格式
-                else:
-                    # 对于其他格式数据不予支持，报400错误
-                    return web.HTTPBadRequest(text='Unsupported Content-Type: %s' % request.content_type)
-
-            elif request.method == 'GET':
-                logging.debug('GET')
-
-                # 返回URL的查询字符串，?后的键值。形如mod=forumdisplay& &fid=30&page=1&filter=author&orderby=dateline
-                query_string = request.query_string
-                # 如果查询字符串不为空，转换为字典类型
-                if query_string:
-                    kwargs = dict()
-                    # parse_qs()解析的字典中value为列表，需要处理
-                    for k, v in parse.parse_qs(query_string, True).items():  # keep_blank_values=True
-                        kwargs[k] = v[0]
-            else:  # 对其他请求方式不处理
-                pass
-
-        # 如果kwargs为空，表示request中没有参数
+        kwargs = await self._bind(request)
+        # 参数有误时_bind()返回400响应
+        if not isinstance(kwargs, dict):
+            return kwargs
+        try:
+            r = self._func(**kwargs)
+            # @get、@post包装后的函数不是协程函数，返回的是协程
+            if inspect.isawaitable(r):
+                r = await r
+            return r
+        # except APIError as e:
+        #     return dict(error=e.error, data=e.data, message=e.message)
+        except (web.HTTPException, DeadlineExceeded):
+            # 交给middleware处理：HTTP异常直接作为响应，超时由deadline_factory返回504
+            raise
+        except Exception as e:
+            return dict(error=e)
+
+
+async def read_json(request):
+    """
+    :return: ``dict`` JSON请求体，有误时返回400响应
+    """
+    params = await request.json()  # 解析body字段的json数据
+    if not isinstance(params, dict):  # 如果request.json()返回的不是dict对象，返回400错误以及提示语
+        return web.HTTPBadRequest(text='JSON body must be  dict object.')
+    return params
+
+
+async def read_form(request):
+    """
+    :return: ``dict`` form表单请求体
+    """
+    params = await request.post()  # 返回post的内容中解析后的数据。dict-like对象。
+    return dict(**params)  # 组成dict，统一kw格式
+
+
+async def read_body(request):
+    """
+    按Content-Type解析POST请求体
+    :return: ``dict`` 参数，有误时返回400响应
+    """
+    content_type = request.content_type.lower()  # 小写，便于检查
+    if not content_type:  # 如果content_type不存在，返回400错误以及'Missing Content-Type.'
+        return web.HTTPBadRequest(text='Missing Content-Type.')
+    if content_type.startswith('application/json'):
+        return await read_json(request)
+    if content_type.startswith('application/x-www-form-urlencoded') or content_type.startswith('multipart/form-data'):
+        return await read_form(request)
+    # 对于其他格式数据不予支持，报400错误
+    return web.HTTPBadRequest(text='Unsupported Content-Type: %s' % request.content_type)
+
+
+async def read_query(request):
+    """
+    :return: ``dict`` URL查询字符串中的参数，同名参数取第一个值；没有查询字符串时返回None
+    """
+    # 返回URL的查询字符串，?后的键值。形如mod=forumdisplay& &fid=30&page=1&filter=author&orderby=dateline
+    query_string = request.query_string
+    if not query_string:
+        return None
+    kwargs = dict()
+    for k, v in parse.parse_qsl(query_string, True):  # keep_blank_values=True
+        if k not in kwargs:
+            kwargs[k] = v
+    return kwargs
+
+
+async def read_any(request):
+    """
+    没有用@get、@post声明请求方式的URL函数，按请求的方法选择
+    """
+    if request.method == 'POST':
+        return await read_body(request)
+    if request.method == 'GET':
+        return await read_query(request)
+    return None
+
+
+def compile_binder(fn, method=None):
+    """
+    由URL函数的签名生成从request中取参数的函数，每个URL函数只分析一次签名，处理请求时不再判断参数种类、也不重复复制参数字典。
+    :param fn: URL函数
+    :param method: ``str`` @get、@post声明的请求方式，GET只读查询字符串，POST只读请求体（JSON或form）
+    :return: async函数bind(request)，返回调用fn的关键字参数``dict``，参数有误时返回400响应
+    """
+    has_request = has_request_arg(fn)
+    params = inspect.signature(fn).parameters
+    var_kw = any(p.kind == inspect.Parameter.VAR_KEYWORD for p in params.values())
+    named = tuple(name for name, p in params.items() if p.kind == inspect.Parameter.KEYWORD_ONLY)
+    required = tuple(name for name, p in params.items()
+                     if p.kind == inspect.Parameter.KEYWORD_ONLY and p.default is inspect.Parameter.empty)
+
+    if not named and not var_kw:
+        # 没有关键字参数：只取路由中的可变字段{variable}
+        async def bind(request):
+            kwargs = dict(request.match_info)
+            if has_request:
+                kwargs['request'] = request
+            return kwargs
+        return bind
+
+    read = dict(GET=read_query, POST=read_body).get(method, read_any)
+    # 没有**kw时只保留命名关键字参数
+    only = None if var_kw else named
+
+    async def bind(request):
+        kwargs = await read(request)
         if kwargs is None:
-            logging.debug('kwargs is None')
-            # request.match_info返回dict对象,封装了与 request 的 path 和 method 完全匹配的 PlainResource 对象
-            # 可变路由中的可变字段{variable}为参数名，传入request请求的path为值
-            # 若存在可变路由：/a/{name}/c，可匹配path为：/a/jack/c的request,则request.match_info返回{name = jack}
-            kwargs = dict(**request.match_info)
-        else:  # request中有参数，按照函数的参数要求，对kwargs中的参数进行处理
-            logging.debug('kwargs is %s' % request)
-            if not self._has_var_kw_arg and self._has_named_kw_args:  # 只有命名关键字参数
-                copy = dict()
-                # 只保留命名关键词参数
-                for name in self._named_kw_args:
-                    if name in kwargs:
-                        copy[name] = kwargs[name]
-                kwargs = copy  # kw中只存在命名关键词参数
-            # 将request.match_info中的参数传入kwargs
+            # request.match_info返回dict对象，可变路由/a/{name}/c匹配/a/jack/c时为{name: jack}
+            kwargs = dict(request.match_info)
+        elif not isinstance(kwargs, dict):
+            return kwargs
+        else:
+            if only is not None:
+                kwargs = {name: kwargs[name] for name in only if name in kwargs}
             for k, v in request.match_info.items():
                 if k in kwargs:
                     logging.warning('Duplicate arg name in named arg and kw args: %s' % k)
                 kwargs[k] = v
-        # 有请求参数，把请求信息装入参数字典
-        if self._has_request_arg:
+        if has_request:
             kwargs['request'] = request
+        # 无默认值的命名关键字参数必须传入
+        for name in required:
+            if name not in kwargs:
+                return web.HTTPBadRequest(text='Missing argument: %s' % name)
+        return kwargs
+    return bind
 
-        # 如果参数中有无默认值的命名关键字参数
-        if self._required_kw_args:
-            for name in self._required_kw_args:
-                # 若未传入参数值，报错。
-                if name not in kwargs:
-                    return web.HTTPBadRequest(text='Missing argument: %s' % name)
 
-        # 至此，kw为视图函数fn真正能调用的参数
-        # request请求中的参数，终于传递给了视图函数
-        logging.info('call with args: %s' % str(kwargs))
-        try:
-            r = await self._func(**kwargs)
-            return r
-        # except APIError as e:
-        #     return dict(error=e.error, data=e.data, message=e.message)
-        except Exception as e:
-            return dict(error=e)
+"""
+条件请求
+
+浏览器带着上次响应的ETag（If-None-Match）或Last-Modified（If-Modified-Since）再次请求时，内容没有变化就回答304，不发送响应体。
+response_factory对GET请求的响应自动计算ETag：URL函数在返回的dict中给出__etag__（例如日志的最大created_at）或
+__last_modified__（时间戳）时，用它们判断，命中就不渲染模板、不序列化JSON；否则对渲染后的响应体计算ETag。
+能在查询数据之前廉价地得到版本的URL函数可以先调用not_modified()，连查询都省掉：
+
+@get('/api/blogs')
+async def api_blogs(request):
+    version = await Blog.findNumber('max(created_at)')
+    resp = not_modified(request, version)
+    if resp is not None:
+        return resp
+    return dict(blogs=await Blog.findall(), __etag__=version)
+"""
+
+
+def make_etag(request, version=None, body=None):
+    """
+    强ETag。由URL函数给出的版本计算时，加上当前用户，登录用户看到的页面不同
+    :param version: 内容的版本，如最大的created_at
+    :param body: ``bytes`` 响应体，没有给出version时使用
+    :return: ``str`` 带引号的ETag
+    """
+    if version is not None:
+        user = getattr(request, '__user__', None)
+        body = repr((version, user.get('id') if user else None)).encode('utf-8')
+    return '"%s"' % hashlib.blake2b(body, digest_size=12).hexdigest()
+
+
+def is_fresh(request, etag=None, last_modified=None):
+    """
+    :param etag: ``str`` 当前内容的ETag
+    :param last_modified: ``float`` 当前内容的修改时间戳
+    :return: ``bool`` 客户端缓存的内容是否仍然有效
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        # 有If-None-Match时忽略If-Modified-Since；If-None-Match按弱比较，去掉W/前缀
+        if etag is None:
+            return False
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if tag == '*' or (tag[2:] if tag.startswith('W/') else tag) == etag:
+                return True
+        return False
+    if last_modified is not None:
+        since = request.if_modified_since
+        return since is not None and int(last_modified) <= since.timestamp()
+    return False
+
+
+def validator_headers(etag=None, last_modified=None):
+    headers = dict()
+    if etag is not None:
+        headers['ETag'] = etag
+    if last_modified is not None:
+        headers['Last-Modified'] = formatdate(last_modified, usegmt=True)
+    return headers
+
+
+def not_modified(request, version=None, last_modified=None):
+    """
+    :param version: 内容的版本，与返回的dict中的__etag__相同
+    :param last_modified: ``float`` 内容的修改时间戳，与__last_modified__相同
+    :return: 客户端缓存有效时返回304响应，否则返回None
+    """
+    etag = make_etag(request, version) if version is not None else None
+    if is_fresh(request, etag, last_modified):
+        return web.Response(status=304, headers=validator_headers(etag, last_modified))
+    return None
 
 
 def add_static(app):
@@ -368,15 +486,11 @@ def add_route(app, fn):
 
     # method and path不能为None，否则报错
     if method and path:
-        # 判断URL处理函数是否协程并且是生成器
-        if not asyncio.iscoroutinefunction(fn) and not inspect.isgeneratorfunction(fn):
-            # 将fn转变成协程
-            fn = asyncio.coroutine(fn)
+        # 普通函数和返回协程的函数都可以，RequestHandler调用后按需await
         logging.info(
             'add route %s %s -> %s(%s)'
             % (method, path, fn.__name__, ', '.join(inspect.signature(fn).parameters.keys())))
         app.router.add_route(method, path, RequestHandler(app, fn))
-        print(fn)
         """
          def add_route(self, method, path, handler,
                        *, name=None, expect_handler=None):
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+"""
+主键生成
+
+原来的next_id()生成50个字符的主键：15位毫秒时间戳加uuid4().hex，随机的后缀让每个索引项（包括外键上的索引）都很大。
+这里用雪花算法生成64位、按时间递增的整数：41位毫秒时间戳（从EPOCH起）、10位worker_id、12位进程内序号，
+再编码成13个字符的base32字符串，字母表按ASCII升序排列并且只用小写字母，在大小写不敏感的排序规则下也保持顺序和唯一。
+
+next_id()使用configure()选择的生成方式：
+snowflake: 13个字符的base32字符串，新建的表可以把主键和外键改成varchar(13)
+compat: 兼容迁移，15位毫秒时间戳加13个字符的base32字符串，和旧的主键按时间一起排序，不用修改已有的表和数据
+legacy: 原来的15位毫秒时间戳加uuid4().hex
+
+snowflake和compat要求显式配置worker_id（0~1023）：多个进程（包括不同主机、不同容器中的进程）写同一个数据库时，
+每个进程的worker_id必须不同，否则同一毫秒内会生成相同的主键。没有配置worker_id时configure()抛出异常，应用无法启动。
+调用configure()之前，next_id()使用legacy方式。
+"""
+import logging, os, time, uuid
+
+# 2018-01-01 00:00:00 UTC，毫秒
+EPOCH = 1514764800000
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER = (1 << WORKER_BITS) - 1
+SEQUENCE_MASK = (1 << SEQUENCE_BITS) - 1
+
+# Crockford base32，去掉了容易混淆的i、l、o、u
+ALPHABET = '0123456789abcdefghjkmnpqrstvwxyz'
+WIDTH = 13  # 64位整数编码后的长度
+_digits = {c: i for i, c in enumerate(ALPHABET)}
+
+
+def encode(n):
+    """
+    :param n: ``int`` 64位非负整数
+    :return: ``str`` 定长13个字符的base32字符串，字符串的顺序和整数的顺序相同
+    """
+    chars = []
+    for _ in range(WIDTH):
+        chars.append(ALPHABET[n & 31])
+        n >>= 5
+    return ''.join(reversed(chars))
+
+
+def decode(s):
+    """
+    :param s: ``str`` encode()的结果
+    :return: ``int``
+    """
+    n = 0
+    for c in s:
+        n = (n << 5) | _digits[c]
+    return n
+
+
+class Snowflake(object):
+    """
+    雪花算法的ID生成器。同一毫秒内的序号用完时借用下一毫秒，时钟回拨时沿用上一次的时间戳，生成的ID始终递增。
+    只在事件循环的线程中调用，没有加锁。
+    """
+
+    def __init__(self, worker_id=0, epoch=EPOCH):
+        """
+        :param worker_id: ``int`` 0~1023，同时写数据库的各个进程必须不同
+        :param epoch: ``int`` 时间戳的起点（毫秒）
+        """
+        if not 0 <= worker_id <= MAX_WORKER:
+            raise ValueError('worker_id must be between 0 and %d: %s' % (MAX_WORKER, worker_id))
+        self.worker_id = worker_id
+        self.epoch = epoch
+        self.last = 0
+        self.sequence = 0
+
+    def next(self):
+        """
+        :return: ``int`` 64位ID
+        """
+        ms = int(time.time() * 1000)
+        if ms <= self.last:
+            ms = self.last
+            self.sequence = (self.sequence + 1) & SEQUENCE_MASK
+            if self.sequence == 0:
+                ms += 1
+        else:
+            self.sequence = 0
+        self.last = ms
+        return ((ms - self.epoch) << (WORKER_BITS + SEQUENCE_BITS)) | (self.worker_id << SEQUENCE_BITS) | self.sequence
+
+    def timestamp(self, n):
+        """
+        :param n: ``int`` next()生成的ID
+        :return: ``int`` 生成时的毫秒时间戳
+        """
+        return (n >> (WORKER_BITS + SEQUENCE_BITS)) + self.epoch
+
+    def snowflake(self):
+        return encode(self.next())
+
+    def compat(self):
+        n = self.next()
+        return '%015d%s' % (self.timestamp(n), encode(n))
+
+
+def legacy():
+    return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)
+
+
+_generator = legacy
+
+
+def configure(mode='legacy', worker_id=None):
+    """
+    选择next_id()的生成方式
+    :param mode: ``str`` snowflake、compat或legacy
+    :param worker_id: ``int`` 雪花算法的worker_id，None时读取环境变量WORKER_ID；snowflake和compat必须给出
+    :return: 生成主键的函数
+    """
+    global _generator
+    if mode == 'legacy':
+        _generator = legacy
+        return _generator
+    if mode not in ('snowflake', 'compat'):
+        raise ValueError('Unknown id mode: %s' % mode)
+    if worker_id is None:
+        worker_id = os.environ.get('WORKER_ID')
+        if worker_id is None:
+            raise ValueError('Id mode %s requires a worker_id unique to each process, '
+                             'set configs.ids.worker_id or the WORKER_ID environment variable' % mode)
+        worker_id = int(worker_id)
+    generator = Snowflake(worker_id)
+    logging.info('ids: mode=%s worker_id=%d' % (mode, worker_id))
+    _generator = getattr(generator, mode)
+    return _generator
+
+
+def next_id():
+    """
+    :return: ``str`` 新的主键
+    """
+    return _generator()
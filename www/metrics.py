@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+"""
+运行时指标
+
+orm在select()、execute()中记录连接池的等待时间、连接占用时间，以及按SQL模板分组的耗时直方图和返回行数。
+在Python中用registry.snapshot()读取，app.init注册的/metrics路由用registry.render()输出文本格式
+（Prometheus exposition format），可以直接被采集。
+"""
+import bisect, functools, re, time
+
+# 直方图的桶（秒）
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# 最多记录的SQL模板个数，超过后归入OTHER，避免拼接了字面量的SQL把内存撑爆
+MAX_TEMPLATES = 500
+OTHER = '<other>'
+
+_in_list = re.compile(r'\(\s*\?(\s*,\s*\?)*\s*\)')
+_values_list = re.compile(r'(values\s*\(\s*\?[^)]*\))(\s*,\s*\(\s*\?[^)]*\))+', re.IGNORECASE)
+_string = re.compile(r"'(?:[^'\\]|\\.)*'")
+_number = re.compile(r'(?<![\w`])-?\d+(\.\d+)?\b')
+
+
+@functools.lru_cache(maxsize=2048)
+def normalize(sql):
+    """
+    把SQL归一化为模板：字面量换成?，in (?, ?, ...)和多行values (...), (...)折叠成一项，
+    这样参数个数不同的同一类查询归入同一个模板
+    :param sql: ``str`` SQL语句
+    :return: ``str`` SQL模板
+    """
+    sql = _string.sub('?', sql)
+    sql = _number.sub('?', sql)
+    sql = _values_list.sub(r'\1, ...', sql)
+    sql = _in_list.sub('(...)', sql)
+    return ' '.join(sql.split())
+
+
+class Histogram(object):
+    """
+    累计直方图，记录每个桶的次数、总次数和总和
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        """
+        :return: ``dict`` 各个桶的累计次数（le为上界）、总次数和总和
+        """
+        cumulative, total = [], 0
+        for le, n in zip(self.buckets + (float('inf'),), self.counts):
+            total += n
+            cumulative.append((le, total))
+        return dict(buckets=cumulative, count=self.count, sum=self.sum)
+
+
+class QueryStats(object):
+    """
+    一个SQL模板的统计
+    """
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.rows = 0
+        self.errors = 0
+
+    def snapshot(self):
+        return dict(latency=self.latency.snapshot(), rows=self.rows, errors=self.errors)
+
+
+class QueryTimer(object):
+    """
+    由Registry.query()创建，with块结束时记录耗时、行数和是否出错
+    """
+    __slots__ = ('registry', 'sql', 'args', 'rows', 'start')
+
+    def __init__(self, registry, sql, args=None):
+        self.registry = registry
+        self.sql = sql
+        self.args = args
+        self.rows = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        error = exc_type is not None
+        self.registry.observe_query(self.sql, seconds, self.rows, error)
+        for hook in self.registry.hooks:
+            hook(self.sql, self.args, seconds, self.rows, error)
+        return False
+
+
+class Registry(object):
+    """
+    指标注册表
+    """
+
+    def __init__(self):
+        self.pool_wait = Histogram()
+        self.pool_hold = Histogram()
+        self.queries = dict()
+        self.gauges = dict()
+        # 每条语句结束时调用的函数：hook(sql, args, seconds, rows, error)，例如querylog的慢查询日志
+        self.hooks = []
+
+    def observe_query(self, sql, seconds, rows=0, error=False):
+        """
+        :param sql: ``str`` 执行的SQL语句，按normalize()后的模板分组
+        :param seconds: ``float`` 耗时
+        :param rows: ``int`` 返回或影响的行数
+        :param error: ``bool`` 是否出错
+        """
+        template = normalize(sql)
+        stats = self.queries.get(template)
+        if stats is None:
+            if len(self.queries) >= MAX_TEMPLATES:
+                template = OTHER
+                stats = self.queries.get(OTHER)
+            if stats is None:
+                stats = self.queries[template] = QueryStats()
+        stats.latency.observe(seconds)
+        stats.rows += rows
+        if error:
+            stats.errors += 1
+
+    def query(self, sql, args=None):
+        """
+        with registry.query(sql, args) as q:
+            ...
+            q.rows = len(result)
+        """
+        return QueryTimer(self, sql, args)
+
+    def add_gauge(self, name, fn, doc=''):
+        """
+        登记一个瞬时值，输出时调用fn()取值，例如连接池中空闲连接的个数
+        """
+        self.gauges[name] = (fn, doc)
+
+    def reset(self):
+        self.pool_wait = Histogram()
+        self.pool_hold = Histogram()
+        self.queries = dict()
+
+    def snapshot(self):
+        """
+        :return: ``dict`` 所有指标的当前值
+        """
+        return dict(
+            pool_wait=self.pool_wait.snapshot(),
+            pool_hold=self.pool_hold.snapshot(),
+            queries={sql: stats.snapshot() for sql, stats in self.queries.items()},
+            gauges={name: fn() for name, (fn, doc) in self.gauges.items()}
+        )
+
+    def render(self):
+        """
+        :return: ``str`` 文本格式的指标
+        """
+        lines = []
+        for name, (fn, doc) in sorted(self.gauges.items()):
+            lines.append('# HELP %s %s' % (name, doc))
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('%s %s' % (name, fn()))
+        render_histogram(lines, 'orm_pool_wait_seconds', 'Time spent waiting for a pooled connection.',
+                         [('', self.pool_wait)])
+        render_histogram(lines, 'orm_pool_hold_seconds', 'Time a connection was held before release.',
+                         [('', self.pool_hold)])
+        queries = sorted(self.queries.items())
+        render_histogram(lines, 'orm_query_duration_seconds', 'Query latency by SQL template.',
+                         [('sql="%s"' % escape(sql), stats.latency) for sql, stats in queries])
+        lines.append('# HELP orm_query_rows_total Rows returned or affected by SQL template.')
+        lines.append('# TYPE orm_query_rows_total counter')
+        for sql, stats in queries:
+            lines.append('orm_query_rows_total{sql="%s"} %s' % (escape(sql), stats.rows))
+        lines.append('# HELP orm_query_errors_total Failed queries by SQL template.')
+        lines.append('# TYPE orm_query_errors_total counter')
+        for sql, stats in queries:
+            lines.append('orm_query_errors_total{sql="%s"} %s' % (escape(sql), stats.errors))
+        return '\n'.join(lines) + '\n'
+
+
+def escape(value):
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def render_histogram(lines, name, doc, series):
+    """
+    :param lines: ``list`` 输出的行
+    :param name: ``str`` 指标名称
+    :param doc: ``str`` 说明
+    :param series: ``list`` of (标签, Histogram)
+    """
+    lines.append('# HELP %s %s' % (name, doc))
+    lines.append('# TYPE %s histogram' % name)
+    for labels, histogram in series:
+        snapshot = histogram.snapshot()
+        prefix = labels + ',' if labels else ''
+        for le, n in snapshot['buckets']:
+            lines.append('%s_bucket{%sle="%s"} %s' % (name, prefix, '+Inf' if le == float('inf') else le, n))
+        suffix = '{%s}' % labels if labels else ''
+        lines.append('%s_sum%s %s' % (name, suffix, snapshot['sum']))
+        lines.append('%s_count%s %s' % (name, suffix, snapshot['count']))
+
+
+registry = Registry()
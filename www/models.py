@@ -8,21 +8,20 @@ Day 4 - 编写Model
 Models for user, blog, comment.
 """
 import time
-import uuid
-from orm import Model, StringField, BooleanField, FloatField, TextField, IntegerField
-
-
-def next_id():
-    return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)
+from orm import Model, StringField, BooleanField, FloatField, TextField, IntegerField, LRUCache, Index, Relation
+# 主键的生成方式由ids.configure()选择，见ids.py
+from ids import next_id
 
 
 class User(Model):
     """ """
 
     __table__ = 'users'
+    # 当前登录用户在每个请求中都要查一次，按主键缓存
+    __cache__ = LRUCache(maxsize=1000, ttl=60)
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    email = StringField(ddl='varchar(50)')
+    email = StringField(ddl='varchar(50)', unique=True)
     passwd = StringField(ddl='varchar(50)')
     admin = BooleanField(default=False)
     name = StringField(ddl='varchar(50)')
@@ -44,17 +43,24 @@ class Blog(Model):
     __table__ = 'blogs'
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    user_id = StringField(ddl='varchar(50)')
+    user_id = StringField(ddl='varchar(50)', index=True)
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
-    content = TextField()
-    created_at = FloatField(default=time.time)
+    # 正文很大，列表页只显示摘要，findall()不读取，需要时用load()加载
+    content = TextField(deferred=True)
+    # 首页按时间倒序分页
+    created_at = FloatField(default=time.time, index=True)
+
+    # 作者只需要名字和头像，不加载passwd、email
+    user = Relation('User', 'user_id', columns=('name', 'image'))
 
 
 class Comment(Model):
     __table__ = 'comments'
+    # 日志页按时间列出一篇日志的评论
+    __indexes__ = (Index('blog_id', 'created_at'),)
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     blog_id = StringField(ddl='varchar(50)')
@@ -64,6 +70,10 @@ class Comment(Model):
     content = TextField()
     created_at = FloatField(default=time.time)
 
+    blog = Relation('Blog', 'blog_id')
+    # 作者只需要名字和头像，不加载passwd、email
+    user = Relation('User', 'user_id', columns=('name', 'image'))
+
 
 if __name__ == '__main__':
     from orm import create_pool
@@ -1,194 +1,1769 @@
 # -*- coding: utf-8 -*-
 
-import logging, asyncio
-import aiomysql
+import logging, asyncio, functools, operator, time, json, base64, contextlib, contextvars, re
+from collections import OrderedDict
 
+import metrics
+from backends import translate, get_backend, DICT, STREAM, TUPLE
 
-def log(sql, args=()):
+
+# 创建连接池
+async def create_pool(loop, **kwargs):
+    """
+    我们需要创建一个全局的连接池，每个HTTP请求都可以从连接池中直接获取数据库连接。使用连接池的好处是不必频繁地打开和关闭数据库连接，
+    而是能复用就尽量复用。连接池由全局变量__pool存储，缺省情况下将编码设置为utf8，自动提交事务：
+    :param loop:
+    :param kwargs: 数据库配置，即configs.db。backend选择数据库后端，默认为mysql，见backends；replicas是只读副本的列表，每一项中没有给出的参数沿用主库的配置；
+                   read_your_writes为True（默认）时，一个请求写过数据库之后，后续的查询都走主库；
+                   replica_lag是副本最多落后主库的秒数（默认1），写表后这段时间内从副本读到的结果不会一直缓存
+    :return:
+    """
+    logging.info('create database connection pool...')
+    global __backend, __pool, __replicas, __read_your_writes, __replica_lag
+    __backend = get_backend(kwargs.pop('backend', 'mysql'))
+    replicas = kwargs.pop('replicas', None) or []
+    __read_your_writes = kwargs.pop('read_your_writes', True)
+    __replica_lag = kwargs.pop('replica_lag', 1)
+    __pool = await __backend.create_pool(loop, **kwargs)
+    __replicas = []
+    for config in replicas:
+        config = dict(kwargs, **config)
+        logging.info('create replica connection pool %s:%s...' % (config.get('host'), config.get('port', 3306)))
+        __replicas.append(Replica(await __backend.create_pool(loop, **config)))
+    metrics.registry.add_gauge('orm_pool_size', lambda: __pool.size, 'Connections opened by the pool.')
+    metrics.registry.add_gauge('orm_pool_free', lambda: __pool.freesize, 'Idle connections in the pool.')
+    metrics.registry.add_gauge('orm_pool_used', lambda: __pool.size - __pool.freesize, 'Connections checked out.')
+    metrics.registry.add_gauge('orm_pool_maxsize', lambda: __pool.maxsize, 'Maximum connections of the pool.')
+    metrics.registry.add_gauge('orm_pool_keepalive_failures', lambda: keepalive_stats['failures'],
+                               'Idle connections that failed the keepalive ping.')
+    if __replicas:
+        metrics.registry.add_gauge('orm_replica_outstanding', lambda: sum(r.outstanding for r in __replicas),
+                                   'Queries in flight on replica pools.')
+
+
+"""
+读写分离
+
+configs.db中声明了replicas时，select()、select_iter()以及find()、findall()等查询从只读副本读取，
+每次选择正在执行的查询最少的副本；execute()、executemany()和事务始终使用主库。
+副本的数据可能稍有延迟，打开read_your_writes后，一个请求写过数据库之后，后续查询都走主库，也可以调用use_primary()显式指定。
+一个请求的状态保存在request_scope()创建的Routing中，请求中创建的子任务（如asyncio.gather()）共享同一个Routing，
+子任务中的写入也会让整个请求固定到主库。
+"""
+__backend = None
+__pool = None
+__replicas = []
+__read_your_writes = True
+__replica_lag = 1
+_routing = contextvars.ContextVar('routing', default=None)
+# 每个表最近一次写入完成（在事务中时为提交）的时间，见replica_settled()
+_table_written_at = dict()
+
+
+class Routing(object):
+    """
+    一个请求的读写分离状态，primary为True时后续的查询都走主库
+    """
+    __slots__ = ('primary',)
+
+    def __init__(self):
+        self.primary = False
+
+
+@contextlib.contextmanager
+def request_scope():
+    """
+    为一个请求创建Routing，app.py的middleware在处理每个请求时进入：
+
+    with orm.request_scope():
+        return await handler(request)
+    """
+    token = _routing.set(Routing())
+    try:
+        yield
+    finally:
+        _routing.reset(token)
+
+
+class Replica(object):
+    """
+    只读副本的连接池，outstanding为正在等待连接或执行中的查询数
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.outstanding = 0
+
+
+def choose_replica():
+    """
+    :return: ``Replica`` 正在执行的查询最少的副本，没有副本或当前请求固定在主库时返回None
+    """
+    if not __replicas or pinned_to_primary():
+        return None
+    return min(__replicas, key=lambda r: r.outstanding)
+
+
+def pinned_to_primary():
+    """
+    :return: ``bool`` 当前请求已经固定在主库
+    """
+    routing = _routing.get()
+    return routing is not None and routing.primary
+
+
+def use_primary():
+    """
+    让当前请求后续的查询都走主库。不在request_scope()中时（脚本、后台任务），只对当前上下文以及之后创建的任务有效
+    """
+    routing = _routing.get()
+    if routing is None:
+        routing = Routing()
+        _routing.set(routing)
+    routing.primary = True
+
+
+def replica_settled(table):
+    """
+    :return: ``bool`` 没有副本，或者距离最近一次写这个表已经超过replica_lag秒，从副本读到的这个表的行可以缓存
+    """
+    if not __replicas:
+        return True
+    written_at = _table_written_at.get(table)
+    return written_at is None or time.monotonic() - written_at >= __replica_lag
+
+
+def wrote(sql):
+    """
+    execute()写数据库前调用：打开了read_your_writes时，当前请求后续的查询都走主库；并更新被写的表的版本号
+    :return: ``str`` 被写的表名，交给written()
+    """
+    if __replicas and __read_your_writes and not pinned_to_primary():
+        use_primary()
+    table = written_table(sql)
+    if table is not None:
+        bump_table_version(table)
+    return table
+
+
+def written(table):
+    """
+    execute()的语句执行完后调用：语句执行期间其他协程仍可能按新版本号缓存旧的结果，执行完（在事务中时为提交后）再更新一次版本号；
+    有副本时，副本追上主库前读到的也是旧的结果，再过replica_lag秒更新一次
+    :param table: ``str`` wrote()的结果
+    """
+    if table is None:
+        return
+    tx = _transaction.get()
+    if tx is not None:
+        tx.after_commit(functools.partial(settle_table_version, table))
+    else:
+        settle_table_version(table)
+
+
+def settle_table_version(table):
+    bump_table_version(table)
+    if __replicas and __replica_lag:
+        _table_written_at[table] = time.monotonic()
+        asyncio.get_event_loop().call_later(__replica_lag, bump_table_version, table)
+
+
+"""
+表版本
+
+每个表有一个版本号，execute()每次写表时，在语句执行前和执行完（事务中为提交后）各加1。按表缓存的查询结果（如findNumber()）把版本号作为缓存键的一部分，
+表没有变化时一直命中缓存，表一旦被写，旧的条目不会再被用到，由LRU自然淘汰。
+只能感知本进程的写入，其他进程的写入靠缓存的ttl兜底。
+"""
+_table_versions = dict()
+_written_table = re.compile(r'^\s*(?:insert\s+(?:ignore\s+)?into|replace\s+into|update|delete\s+from)\s+`?(\w+)`?',
+                            re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=1024)
+def written_table(sql):
+    """
+    :param sql: ``str`` INSERT、UPDATE、DELETE语句
+    :return: ``str`` 被写的表名，无法识别时返回None
+    """
+    m = _written_table.match(sql)
+    return m.group(1) if m else None
+
+
+def table_version(table):
+    return _table_versions.get(table, 0)
+
+
+def bump_table_version(table):
+    _table_versions[table] = _table_versions.get(table, 0) + 1
+
+
+"""
+事务
+
+autocommit打开时，每条语句都从连接池取一个连接、单独提交。需要把多条语句作为一个整体提交时使用transaction()：
+
+async with orm.transaction():
+    await comment.save()
+    await execute('update `blogs` set `comments`=`comments`+1 where `id`=?', [blog_id])
+
+块内的select()、execute()以及Model的各个方法都使用同一个连接，正常退出时提交，抛出异常时回滚。
+当前事务保存在contextvars中，只对进入事务的协程（以及它创建的任务）可见。
+"""
+_transaction = contextvars.ContextVar('transaction', default=None)
+
+
+def get_pool():
+    return __pool
+
+
+def current_backend():
+    """
+    :return: ``Backend`` 当前使用的数据库后端
+    """
+    return __backend
+
+
+async def close_pool():
+    """
+    写完延迟写入的队列，关闭主库和副本的连接池
+    """
+    global _keepalive_task
+    await flush_writes()
+    if _keepalive_task is not None:
+        _keepalive_task.cancel()
+        _keepalive_task = None
+    for name, pool in pools():
+        pool.close()
+        await pool.wait_closed()
+
+
+"""
+连接池维护
+
+连接池默认只有minsize个连接，部署后的第一波请求要串行地建立TCP连接和认证，app.init在开始监听前用warm_up()预先打开连接；
+空闲连接可能被MySQL（wait_timeout）或中间的防火墙悄悄断开，start_keepalive()启动的后台任务定期ping空闲的连接，
+失败的连接被关闭并从连接池中丢弃，而不是在请求中才报错；configs.db的pool_recycle限制连接的最长使用时间，到期的连接在取出时重建。
+"""
+_keepalive_task = None
+keepalive_stats = dict(pings=0, failures=0)
+
+
+def pools():
+    """
+    :return: ``list`` of (名称, 连接池)，包括主库和各个副本
+    """
+    result = [('primary', __pool)] if __pool is not None else []
+    result.extend(('replica%d' % i, r.pool) for i, r in enumerate(__replicas))
+    return result
+
+
+async def warm_up(size):
+    """
+    为主库和每个副本并发地打开size个连接（不超过maxsize）后放回连接池
+    :param size: ``int`` 每个连接池预先打开的连接数
+    """
+    for name, pool in pools():
+        n = min(size, pool.maxsize)
+        if n <= pool.size:
+            continue
+        start = time.perf_counter()
+        conns = await asyncio.gather(*[acquire(pool) for _ in range(n)], return_exceptions=True)
+        for c in conns:
+            if not isinstance(c, BaseException):
+                release(c[0], c[1], pool)
+        errors = [c for c in conns if isinstance(c, BaseException)]
+        if errors:
+            logging.warning('warm up %s: %s of %s connections failed: %s' % (name, len(errors), n, errors[0]))
+        logging.info('warm up %s: %s connections in %.3fs' % (name, pool.size, time.perf_counter() - start))
+
+
+async def ping_idle(pool):
+    """
+    依次取出连接池中的空闲连接ping一次，失败的连接关闭后丢弃
+    """
+    for _ in range(pool.freesize):
+        conn, acquired = await acquire(pool)
+        try:
+            await conn.ping()
+            keepalive_stats['pings'] += 1
+        except Exception as e:
+            keepalive_stats['failures'] += 1
+            logging.warning('keepalive ping failed, dropping connection: %s' % e)
+            conn.close()
+        finally:
+            release(conn, acquired, pool)
+
+
+async def keepalive(interval):
+    while True:
+        await asyncio.sleep(interval)
+        for name, pool in pools():
+            try:
+                await ping_idle(pool)
+            except Exception as e:
+                logging.warning('keepalive %s: %s' % (name, e))
+
+
+def start_keepalive(interval):
+    """
+    启动后台任务，每interval秒ping一次所有空闲连接，close_pool()时停止
+    :param interval: ``float`` 间隔秒数，0表示不启动
+    """
+    global _keepalive_task
+    if interval and _keepalive_task is None:
+        _keepalive_task = asyncio.ensure_future(keepalive(interval))
+
+
+def pool_stats():
+    """
+    :return: ``list`` of ``dict`` 每个连接池的连接数、空闲和占用的连接数、上限
+    """
+    return [dict(name=name, size=pool.size, free=pool.freesize, used=pool.size - pool.freesize,
+                 minsize=pool.minsize, maxsize=pool.maxsize) for name, pool in pools()]
+
+
+"""
+截止时间
+
+app.py的deadline_factory为每个请求设置时间预算，请求中的select()、execute()等候连接和执行语句都不能超过截止时间：
+
+with orm.deadline(5):
+    blogs = await Blog.findall()
+
+超时时抛出DeadlineExceeded。MySQL后端给SELECT加上MAX_EXECUTION_TIME提示，由服务器自己终止查询；
+客户端超时或者请求被取消（例如客户端断开）时，由后端的interrupt()中断连接上正在执行的语句，再把连接交还连接池：
+MySQL关闭这个连接并用KILL QUERY终止服务器上的语句，连接池会丢弃已关闭的连接；SQLite用sqlite3的interrupt()，连接可以继续使用。
+"""
+_deadline = contextvars.ContextVar('deadline', default=None)
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    pass
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    """
+    :param seconds: ``float`` with块中的查询共享的时间预算，嵌套时以较早的截止时间为准
+    """
+    at = time.monotonic() + seconds
+    current = _deadline.get()
+    if current is not None and current < at:
+        at = current
+    token = _deadline.set(at)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining():
+    """
+    :return: ``float`` 距截止时间的秒数，没有设置截止时间时为None
+    """
+    at = _deadline.get()
+    if at is None:
+        return None
+    timeout = at - time.monotonic()
+    if timeout <= 0:
+        raise DeadlineExceeded('query deadline exceeded')
+    return timeout
+
+
+async def within(aw, timeout):
+    """
+    等待aw，最多timeout秒
+    :param timeout: ``float`` remaining()的结果，None表示不限时间
+    """
+    if timeout is None:
+        return await aw
+    try:
+        return await asyncio.wait_for(aw, timeout)
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded('query deadline exceeded') from None
+
+
+async def run(conn, aw, timeout):
+    """
+    在截止时间内等待连接上的一个操作，超时或者被取消时中断连接上正在执行的语句
+    :param conn: 执行语句的连接
+    :param aw: 游标的execute()、fetchall()等
+    :param timeout: ``float`` remaining()的结果，要在创建aw之前取得，已经超时时不会留下没有await的协程
+    """
+    try:
+        return await within(aw, timeout)
+    except (asyncio.CancelledError, asyncio.TimeoutError):
+        __backend.interrupt(conn)
+        raise
+
+
+async def acquire(pool=None):
+    """
+    从连接池取一个连接，记录等待时间。设置了截止时间时最多等到截止时间
+    :param pool: 连接池，默认为主库
+    :return: 连接和取得连接的时间
+    """
+    pool = pool or __pool
+    start = time.perf_counter()
+    # 先取剩余时间：已经超时时remaining()抛出异常，不创建acquire()协程
+    timeout = remaining()
+    conn = await within(pool.acquire(), timeout)
+    acquired = time.perf_counter()
+    metrics.registry.pool_wait.observe(acquired - start)
+    return conn, acquired
+
+
+def release(conn, acquired, pool=None):
+    """
+    把连接归还连接池，记录占用时间
+    """
+    metrics.registry.pool_hold.observe(time.perf_counter() - acquired)
+    (pool or __pool).release(conn)
+
+
+class Transaction(object):
+    """
+    由transaction()创建。嵌套使用时，内层直接加入外层事务，由最外层负责提交或回滚。
+    """
+
+    def __init__(self):
+        self.conn = None
+        self._acquired = None
+        # 同一个连接上不能同时执行两条语句，事务内并发的查询按顺序执行
+        self.lock = asyncio.Lock()
+        # select_iter()迭代期间一直占用连接
+        self.streaming = False
+        self._outer = None
+        self._token = None
+        self._after_commit = []
+
+    def after_commit(self, callback):
+        """
+        登记提交成功后要执行的回调，例如让缓存失效
+        """
+        self._after_commit.append(callback)
+
+    async def __aenter__(self):
+        outer = _transaction.get()
+        if outer is not None:
+            self._outer = outer
+            return outer
+        self.conn, self._acquired = await acquire()
+        try:
+            await self.conn.begin()
+        except Exception:
+            release(self.conn, self._acquired)
+            raise
+        self._token = _transaction.set(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self._outer is not None:
+            return False
+        _transaction.reset(self._token)
+        try:
+            if exc_type is None:
+                await self.conn.commit()
+            else:
+                try:
+                    await self.conn.rollback()
+                except Exception as e:
+                    # 超时中断时连接可能已经关闭，服务器会在连接断开时回滚
+                    logging.warning('rollback failed: %s' % e)
+        finally:
+            release(self.conn, self._acquired)
+        if exc_type is None:
+            for callback in self._after_commit:
+                callback()
+        return False
+
+
+def transaction():
+    """
+    :return: ``Transaction`` 用async with进入的事务
+    """
+    return Transaction()
+
+
+def current_transaction():
+    """
+    :return: ``Transaction`` 当前协程所在的事务，不在事务中时返回None
+    """
+    return _transaction.get()
+
+
+@contextlib.asynccontextmanager
+async def connection(readonly=False, stream=False):
+    """
+    取得执行SQL的连接：在事务中时使用事务固定的连接，否则从连接池中取一个，用完归还
+    :param readonly: ``bool`` 只读的查询可以使用副本
+    :param stream: ``bool`` select_iter()使用，迭代结束前一直占用连接
+    """
+    tx = _transaction.get()
+    if tx is not None:
+        if tx.streaming:
+            # 等待tx.lock会一直等到迭代结束，而迭代又在等这条语句，直接报错而不是死锁
+            raise RuntimeError('Transaction connection is busy streaming select_iter() results, '
+                               'finish the iteration before executing another statement in the transaction')
+        async with tx.lock:
+            tx.streaming = stream
+            try:
+                yield tx.conn
+            finally:
+                tx.streaming = False
+        return
+    replica = choose_replica() if readonly else None
+    if replica is None:
+        conn, acquired = await acquire()
+        try:
+            yield conn
+        finally:
+            release(conn, acquired)
+        return
+    replica.outstanding += 1
+    try:
+        conn, acquired = await acquire(replica.pool)
+        try:
+            yield conn
+        finally:
+            release(conn, acquired, replica.pool)
+    finally:
+        replica.outstanding -= 1
+
+
+# Select
+async def select(sql, args, size=None, kind=DICT):
+    """
+    要执行SELECT语句，我们用select函数执行，需要传入SQL语句和SQL参数：
+    :param sql: ``str`` SQL语句
+    :param args: ``tuple`` SQL参数
+    :param size:``int`` number of rows to return. 如果传入size参数，就通过fetchmany()获取最多指定数量的记录，否则，通过fetchall()获取所有记录。
+    :param kind: 游标类型，默认每行是dict；Model的列表查询用TUPLE，由Model.from_tuples()按字段顺序生成实例
+    :return:``list`` of fetched rows
+    """
+    async with connection(readonly=True) as conn:
+        # 创建一个DictCursor类指针，返回dict形式的结果集
+        # 以上下文方式创建cur指针，无需再调用cur.close()
+        with metrics.registry.query(sql, args) as timer:
+            async with __backend.cursor(conn, kind) as cur:
+                # SQL语句的占位符是?，而MySQL的占位符是 % s，select() 函数在内部自动替换。
+                # 注意要始终坚持使用带参数的SQL，而不是自己拼接SQL字符串，这样可以防止SQL注入攻击。
+                timeout = remaining()
+                statement = __backend.translate(sql)
+                if timeout is not None:
+                    statement = __backend.limit_time(statement, timeout)
+                await run(conn, cur.execute(statement, args or ()), timeout)
+                timeout = remaining()
+                if size:
+                    result = await run(conn, cur.fetchmany(size), timeout)
+                else:
+                    result = await run(conn, cur.fetchall(), timeout)
+            timer.rows = len(result)
+        return result
+
+
+async def select_iter(sql, args, chunk=500):
+    """
+    用非缓冲的服务器端游标(SSDictCursor)执行SELECT，每次fetchmany()取chunk行，整个结果集不会一次读进内存。
+    迭代结束前一直占用同一个连接，提前退出时用aclose()关闭生成器，以便及时归还连接。
+    在事务中迭代时，迭代结束前在同一个事务中执行其他语句会抛出RuntimeError。
+    :param sql: ``str`` SQL语句
+    :param args: ``tuple`` SQL参数
+    :param chunk: ``int`` 每次读取的行数
+    :return: async generator of ``list`` of fetched rows
+    """
+    async with connection(readonly=True, stream=True) as conn:
+        # 耗时包括调用者处理每一批数据的时间
+        with metrics.registry.query(sql, args) as timer:
+            async with __backend.cursor(conn, STREAM) as cur:
+                timeout = remaining()
+                await run(conn, cur.execute(__backend.translate(sql), args or ()), timeout)
+                while True:
+                    timeout = remaining()
+                    rows = await run(conn, cur.fetchmany(chunk), timeout)
+                    if not rows:
+                        break
+                    timer.rows += len(rows)
+                    yield rows
+
+
+# Insert, Update, Delete
+# 要执行INSERT、UPDATE、DELETE语句，可以定义一个通用的execute()函数，因为这3种SQL的执行都需要相同的参数，以及返回一个整数表示影响的行数：
+async def execute(sql, args, autocommit=True):
+    """Executes the given Insert, Update or Delete operation
+
+        Executes the given operation substituting any markers with
+        the given parameters.
+
+        For example, getting all rows where id is 5:
+          cursor.execute("INSERT INTO Websites (name, url, alexa, country) VALUES (%s,%s,%s,%s)",
+          ('百度','https://www.baidu.com/','4','CN'))
+
+    :param sql: ``str`` sql statement
+    :param args: ``tuple`` or ``list`` of arguments for sql query
+    :param autocommit:``bool``, toggle autocommit. False时这条语句在单独的事务中执行，已经在事务中时不起作用
+    :return: ``int``, number of rows that has been produced of affected
+    """
+    if not autocommit and _transaction.get() is None:
+        async with transaction():
+            return await execute(sql, args)
+    table = wrote(sql)
+    try:
+        async with connection() as pool_connect:
+            with metrics.registry.query(sql, args) as timer:
+                async with __backend.cursor(pool_connect, DICT) as pool_cur:
+                    timeout = remaining()
+                    await run(pool_connect, pool_cur.execute(__backend.translate(sql), args), timeout)
+                    rows_affected = pool_cur.rowcount  # Returns the number of rows that has been produced of affected.
+                timer.rows = rows_affected
+            return rows_affected
+    finally:
+        written(table)
+
+
+async def executemany(sql, seq_of_args):
+    """
+    用同一条语句批量执行多组参数，整批只占用一次连接。对INSERT ... VALUES语句，驱动会把多组参数合并成一条多行INSERT。
+    :param sql: ``str`` sql statement
+    :param seq_of_args: ``list`` of ``tuple`` or ``list``, 每一行的参数
+    :return: ``int``, number of rows that has been produced of affected
+    """
+    table = wrote(sql)
+    try:
+        async with connection() as pool_connect:
+            with metrics.registry.query(sql) as timer:
+                async with __backend.cursor(pool_connect, DICT) as pool_cur:
+                    timeout = remaining()
+                    await run(pool_connect, pool_cur.executemany(__backend.translate(sql), seq_of_args), timeout)
+                    timer.rows = pool_cur.rowcount
+            return timer.rows
+    finally:
+        written(table)
+
+
+async def create_tables(*models):
+    """
+    按模型的DDL建表，表已存在时跳过；再创建__indexes__中声明、但数据库中还没有的索引
+    :param models: Model的子类
+    """
+    import schema
+    for model in models:
+        await execute(model.ddl(__backend.table_options), ())
+        for sql in schema.migration(model, await schema.live_indexes(model)):
+            await execute(sql, ())
+
+
+"""
+ORM
+
+有了基本的select()和execute()函数，我们就可以开始编写一个简单的ORM了。
+设计ORM需要从上层调用者角度来设计。
+我们先考虑如何定义一个User对象，然后把数据库表users和它关联起来。
+
+from orm import Model, StringField, IntegerField
+
+class User(Model):
+    __table__ = 'users'
+
+    id = IntegerField(primary_key=True)
+    name = StringField()
+
+注意到定义在User类中的__table__、id和name是类的属性，不是实例的属性。
+所以，在类级别上定义的属性用来描述User对象和表的映射关系，而实例属性必须通过__init__()方法去初始化，所以两者互不干扰：
+
+# 创建实例:
+user = User(id=123, name='Michael')
+# 存入数据库:
+user.insert()
+# 查询所有User对象:
+users = User.findAll()
+"""
+
+
+# Field和各种Field子类，用于映射各种数据字段：
+class Field(object):
+    def __init__(self, name, column_type, primary_key, default, deferred=False, index=False, unique=False):
+        """
+        各种数据字段的基类
+        :param name:``str``字段名称
+        :param column_type:``str`` the type of field
+        :param primary_key:``bool`` 是否为主键
+        :param default:
+        :param deferred:``bool`` 是否延迟加载。findall()等列表查询不读取延迟加载的字段，用到时再调用load()加载，见Deferred
+        :param index:``bool`` 是否为这个字段建索引，多个字段的组合索引用Model的__indexes__声明，见Index
+        :param unique:``bool`` 是否为这个字段建唯一索引
+        """
+        self.name = name
+        self.column_type = column_type
+        self.primary_key = primary_key
+        self.default = default
+        self.deferred = deferred
+        self.index = index
+        self.unique = unique
+
+    def __str__(self):
+        return '<%s, %s:%s>' % (self.__class__.__name__, self.column_type, self.name)
+
+    def __getattr__(self, item):
+        for item in ['name', 'column_type', 'primary_key', 'default']:
+            return self[item]
+
+
+def create_args_string(num):
+    """
+    create args string
+    :param num: ``int`` the number of args
+    :return:``list'' of args of string
+    """
+    L = []
+    for n in range(num):
+        L.append('?')
+    return ', '.join(L)
+
+
+@functools.lru_cache(maxsize=256)
+def compile_count(table, select_field, where=None):
+    """
+    findNumber()的SQL语句，按(表, 查询表达式, 条件)缓存
+    """
+    sql = ['select %s _num_ from `%s`' % (select_field, table)]
+    if where:
+        sql.append('where')
+        sql.append(where)
+    sql = ' '.join(sql)
+    translate(sql)
+    return sql
+
+
+@functools.lru_cache(maxsize=1)
+def compile_table_rows():
+    """
+    从information_schema读取表的估计行数，InnoDB的TABLE_ROWS是采样得到的近似值
+    """
+    sql = 'select `TABLE_ROWS` _num_ from `information_schema`.`TABLES` where `TABLE_SCHEMA`=database() and `TABLE_NAME`=?'
+    translate(sql)
+    return sql
+
+
+@functools.lru_cache(maxsize=256)
+def compile_insert_many(insert, num):
+    """
+    把单行INSERT语句扩展为num行的INSERT ... VALUES (...), (...)，结果按(语句, 行数)缓存
+    :param insert: ``str`` 模型的__insert__
+    :param num: ``int`` 行数
+    :return: ``str`` 使用?占位符的SQL语句
+    """
+    values = insert[insert.rindex(' values ') + len(' values '):]
+    sql = insert + (', ' + values) * (num - 1)
+    translate(sql)
+    return sql
+
+
+@functools.lru_cache(maxsize=256)
+def compile_upsert(backend, insert, primary_key, columns, num=1):
+    """
+    num行的INSERT语句，主键冲突时改为更新columns，语法由后端决定，结果按(后端, 语句, 字段, 行数)缓存
+    :param backend: ``Backend``
+    :param insert: ``str`` 模型的__insert__
+    :param primary_key: ``str`` 主键
+    :param columns: ``tuple`` 主键冲突时更新的字段
+    :param num: ``int`` 行数
+    :return: ``str`` 使用?占位符的SQL语句
+    """
+    sql = backend.upsert(compile_insert_many(insert, num), primary_key, columns)
+    translate(sql)
+    return sql
+
+
+def batches(items, batch_size):
+    """
+    按batch_size把items分组
+    :param items: ``list``
+    :param batch_size: ``int`` 每组的最大个数
+    :return: generator of ``list``
+    """
+    if batch_size < 1:
+        raise ValueError('Invalid batch size: %s' % batch_size)
+    for i in range(0, len(items), batch_size):
+        yield items[i:i + batch_size]
+
+
+# BIGINT 8 字节 	(-9 233 372 036 854 775 808，9 223 372 036 854 775 807) 	(0，18 446 744 073 709 551 615) 	极大整数值
+class IntegerField(Field):
+    def __init__(self, name=None, primary_key=False, default=0, index=False, unique=False):
+        super().__init__(name, 'bigint', primary_key, default, index=index, unique=unique)
+
+
+# VARCHAR 	0-65535 字节 	变长字符串
+class StringField(Field):
+    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)', deferred=False,
+                 index=False, unique=False):
+        super().__init__(name, ddl, primary_key, default, deferred, index, unique)
+
+
+# BOOL / BOOLEAN 布尔类型
+class BooleanField(Field):
+    def __init__(self, name=None, default=None, index=False):
+        super().__init__(name, 'boolean', False, default, index=index)
+
+
+# REAL就是DOUBLE ，如果SQL服务器模式包括REAL_AS_FLOAT选项，REAL是FLOAT的同义词而不是DOUBLE的同义词。
+class FloatField(Field):
+    def __init__(self, name=None, primary_key=False, default=0.0, index=False, unique=False):
+        super().__init__(name, 'real', primary_key, default, index=index, unique=unique)
+
+
+# text 	string长度+2字节 	字符串，最大长度为0-65535个字节
+class TextField(Field):
+    def __init__(self, name=None, default=None, deferred=False):
+        super().__init__(name, 'text', False, default, deferred)
+
+
+class Index(object):
+    """
+    索引声明。单个字段的索引在Field上用index=True或unique=True声明，组合索引在Model的__indexes__中声明：
+
+    class Comment(Model):
+        __table__ = 'comments'
+        __indexes__ = (Index('blog_id', 'created_at'),)
+
+    ModelMetaclass把两者合并到__indexes__中，未指定名称时按表名和字段名生成，如idx_comments_blog_id_created_at。
+    """
+
+    def __init__(self, *columns, unique=False, name=None):
+        """
+        :param columns: ``str`` 按顺序排列的字段名
+        :param unique: ``bool`` 是否唯一索引
+        :param name: ``str`` 索引名称
+        """
+        if not columns:
+            raise ValueError('Index needs at least one column')
+        self.columns = tuple(columns)
+        self.unique = unique
+        self.name = name
+
+    def bind(self, table):
+        """
+        :return: ``Index`` 补全了名称的索引
+        """
+        name = self.name or '%s_%s_%s' % ('uniq' if self.unique else 'idx', table, '_'.join(self.columns))
+        return Index(*self.columns, unique=self.unique, name=name)
+
+    def __eq__(self, other):
+        if not isinstance(other, Index):
+            return NotImplemented
+        return self.columns == other.columns and self.unique == other.unique
+
+    def __hash__(self):
+        return hash((self.columns, self.unique))
+
+    def __str__(self):
+        return '<%s %s(%s)>' % ('Unique' if self.unique else 'Index', self.name, ', '.join(self.columns))
+
+    __repr__ = __str__
+
+
+class Relation(object):
+    """
+    多对一关系声明。本表的字段保存另一张表的主键，例如：
+
+    class Comment(Model):
+        blog_id = StringField(ddl='varchar(50)')
+        blog = Relation('Blog', 'blog_id')
+
+    关系不是字段，不读写数据库。findall(prefetch=['blog'])对每个关系用一条 select ... where `pk` in (...)
+    加载所有结果引用的行，作为comment.blog附加到实例上，没有找到时为None；'blog.user'这样的路径继续加载下一层关系。
+    columns限定加载的字段，例如作者只需要名字和头像时Relation('User', 'user_id', columns=('name', 'image'))，
+    不会把passwd等字段一起查出来、再被API序列化出去。
+    """
+
+    def __init__(self, model, column, columns=None):
+        """
+        :param model: Model的子类，或者类名（关联的类在后面定义时）
+        :param column: ``str`` 本表中保存关联行主键的字段
+        :param columns: ``tuple`` 只加载主键和这些字段，见compile_projection()；默认加载除延迟加载字段以外的所有字段
+        """
+        self._model = model
+        self.column = column
+        self.columns = tuple(columns) if columns is not None else None
+        self.name = None
+
+    @property
+    def model(self):
+        if isinstance(self._model, str):
+            if self._model not in models:
+                raise Exception('Model not found for relation %s: %s' % (self.name, self._model))
+            self._model = models[self._model]
+        return self._model
+
+    async def load(self, instances):
+        """
+        为instances加载关联的行
+        :param instances: ``list`` 本表的实例
+        :return: ``list`` 加载到的关联实例
+        """
+        model = self.model
+        if self.columns is None:
+            select_list, unloaded = model.__select_list__, model.__deferred__
+        else:
+            select_list, unloaded = compile_projection(model, self.columns)
+        pks = list({i[self.column] for i in instances if i.get(self.column) is not None})
+        rows = dict()
+        for batch in batches(pks, 500):
+            rs = await select(compile_find_many(select_list, model.__primary_key__, len(batch)), batch, kind=TUPLE)
+            for r in model.from_tuples(rs, unloaded):
+                rows[r[model.__primary_key__]] = r
+        for instance in instances:
+            dict.__setitem__(instance, self.name, rows.get(instance.get(self.column)))
+        return list(rows.values())
+
+    def __str__(self):
+        return '<Relation %s(%s -> %s)>' % (self.name, self.column, getattr(self._model, '__name__', self._model))
+
+    __repr__ = __str__
+
+
+"""
+查询构造器
+
+ModelMetaclass为每个字段生成一个Column描述符，在类上访问得到列表达式，在实例上访问得到字段的值：
+
+blogs = await Blog.where(Blog.user_id == uid).order_by(Blog.created_at.desc()).limit(10).all()
+
+同一形状（条件、排序、limit个数相同）的查询只拼接一次SQL，由compile_select()缓存，之后每次只需要绑定参数。
+构造器每次调用仍要创建Condition和Query对象，比直接传SQL片段的findall()慢约2us。热点查询可以用prepare()只构造一次，
+之后每次调用只绑定参数：
+
+recent_blogs = Blog.where(Blog.user_id == '').order_by(Blog.created_at.desc()).limit(0, 10).prepare()
+blogs = await recent_blogs.all(uid, 0, 10)
+"""
+
+
+class Condition(object):
+    """
+    查询条件，sql是带?占位符的SQL片段，args是对应的参数。条件之间可以用&、|、~组合。
+    """
+    __slots__ = ('sql', 'args')
+
+    def __init__(self, sql, args=()):
+        self.sql = sql
+        self.args = args if type(args) is tuple else tuple(args)
+
+    def __and__(self, other):
+        return Condition('(%s and %s)' % (self.sql, other.sql), self.args + other.args)
+
+    def __or__(self, other):
+        return Condition('(%s or %s)' % (self.sql, other.sql), self.args + other.args)
+
+    def __invert__(self):
+        return Condition('not (%s)' % self.sql, self.args)
+
+    def __str__(self):
+        return '<Condition %s %s>' % (self.sql, self.args)
+
+
+class Column(object):
+    """
+    列表达式。比较运算返回Condition，SQL片段在创建时就拼好，构造查询时不再做字符串格式化。
+    """
+
+    def __init__(self, name):
+        self.name = name
+        escaped = '`%s`' % name
+        self.escaped = escaped
+        self._sql = {op: '%s%s?' % (escaped, op) for op in ('=', '<>', '<', '<=', '>', '>=')}
+        self._eq = self._sql['=']
+        self._is_null = '%s is null' % escaped
+        self._is_not_null = '%s is not null' % escaped
+        self._like = '%s like ?' % escaped
+        self._asc = '%s asc' % escaped
+        self._desc = '%s desc' % escaped
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        try:
+            return instance[self.name]
+        except KeyError:
+            raise AttributeError(r"'Model' object has no attribute '%s'" % self.name)
+
+    def __eq__(self, other):
+        if other is None:
+            return Condition(self._is_null)
+        return Condition(self._eq, (other,))
+
+    def __ne__(self, other):
+        if other is None:
+            return Condition(self._is_not_null)
+        return Condition(self._sql['<>'], (other,))
+
+    def __lt__(self, other):
+        return Condition(self._sql['<'], (other,))
+
+    def __le__(self, other):
+        return Condition(self._sql['<='], (other,))
+
+    def __gt__(self, other):
+        return Condition(self._sql['>'], (other,))
+
+    def __ge__(self, other):
+        return Condition(self._sql['>='], (other,))
+
+    __hash__ = object.__hash__
+
+    def in_(self, values):
+        values = tuple(values)
+        if not values:
+            return Condition('1=0')
+        return Condition('%s in (%s)' % (self.escaped, create_args_string(len(values))), values)
+
+    def like(self, pattern):
+        return Condition(self._like, (pattern,))
+
+    def asc(self):
+        return self._asc
+
+    def desc(self):
+        return self._desc
+
+    def __str__(self):
+        return '<Column %s>' % self.name
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_select(select, where=None, orderby=None, limit=0):
+    """
+    拼接SELECT语句，结果按查询形状缓存，并预先转换好MySQL占位符。
+    每个形状只在第一次拼接时记录到query_shapes中，schema.check()用它检查缺少的索引
+    :param select: ``str`` 模型的__select__
+    :param where: ``str`` 或 ``tuple`` WHERE子句，tuple中的各个条件用and连接
+    :param orderby: ``str`` 或 ``tuple`` ORDER BY子句
+    :param limit: ``int`` limit参数的个数，0、1或2
+    :return: ``str`` 使用?占位符的SQL语句
+    """
+    if where and not isinstance(where, str):
+        where = ' and '.join(where)
+    if orderby and not isinstance(orderby, str):
+        orderby = ', '.join(orderby)
+    sql = [select]
+    if where:
+        sql.append('where')
+        sql.append(where)
+    if orderby:
+        sql.append('order by')
+        sql.append(orderby)
+    if limit == 1:
+        sql.append('limit ?')
+    elif limit == 2:
+        sql.append('limit ?, ?')
+    sql = ' '.join(sql)
+    translate(sql)
+    if (where or orderby) and len(query_shapes) < MAX_QUERY_SHAPES:
+        query_shapes.add((select, where or None, orderby or None))
+    return sql
+
+
+# compile_select()拼接过的查询形状：(SELECT语句, WHERE子句, ORDER BY子句)，子句都是拼接好的``str``
+query_shapes = set()
+MAX_QUERY_SHAPES = 1000
+
+
+def limit_args(limit):
+    """
+    检查limit参数
+    :param limit: ``int`` 或 ``tuple`` (offset, count)
+    :return: ``tuple`` limit的参数
+    """
+    if limit is None:
+        return ()
+    if isinstance(limit, int):
+        return limit,
+    if isinstance(limit, tuple) and len(limit) == 2:
+        return limit
+    raise ValueError('Invalid limit value: %s' % str(limit))
+
+
+@functools.lru_cache(maxsize=64)
+def compile_seek(key, primary_key, desc=True):
+    """
+    键集分页（seek）的条件和排序：按(key, 主键)排序，从上一页最后一行之后继续，不需要offset
+    :param key: ``str`` 排序字段，如created_at
+    :param primary_key: ``str`` 主键，key相同时用来确定顺序
+    :param desc: ``bool`` 是否倒序
+    :return: ``tuple`` (条件, ORDER BY子句)，条件的参数为(key值, key值, 主键值)
+    """
+    op, direction = ('<', 'desc') if desc else ('>', 'asc')
+    where = '(`%s`%s? or (`%s`=? and `%s`%s?))' % (key, op, key, primary_key, op)
+    orderby = '`%s` %s, `%s` %s' % (key, direction, primary_key, direction)
+    return where, orderby
+
+
+def encode_page_token(values):
+    """
+    把最后一行的(key值, 主键值)编码为不透明的翻页令牌
+    """
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_page_token(token):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError):
+        raise ValueError('Invalid page token: %s' % token)
+    if not isinstance(values, list) or len(values) != 2:
+        raise ValueError('Invalid page token: %s' % token)
+    return values
+
+
+class Query(object):
+    """
+    由Model.where()创建的查询，where()、order_by()、limit()修改查询本身并返回self，可以链式调用。
+    """
+    __slots__ = ('model', '_select', '_unloaded', '_where', '_args', '_orderby', '_limit')
+
+    def __init__(self, model, conditions=()):
+        self.model = model
+        self._select = model.__select_list__
+        self._unloaded = model.__deferred__
+        self._orderby = ()
+        self._limit = ()
+        # Model.where()传入的条件直接放进查询，不再调用where()
+        if len(conditions) == 1:
+            c = conditions[0]
+            self._where = (c.sql,)
+            self._args = c.args
+        else:
+            self._where = ()
+            self._args = ()
+            self.where(*conditions)
+
+    def columns(self, *columns):
+        """ 只查询主键和这些字段，见Model.findall()的columns参数 """
+        self._select, self._unloaded = compile_projection(self.model, columns)
+        return self
+
+    def where(self, *conditions):
+        # 最常见的是一个条件，不用循环拼接tuple
+        if len(conditions) == 1 and not self._where:
+            c = conditions[0]
+            self._where = (c.sql,)
+            self._args = c.args
+            return self
+        for c in conditions:
+            self._where += (c.sql,)
+            self._args += c.args
+        return self
+
+    def order_by(self, *columns):
+        for c in columns:
+            self._orderby += (c._asc if isinstance(c, Column) else c,)
+        return self
+
+    def limit(self, *limit):
+        if len(limit) == 2:
+            self._limit = limit
+        else:
+            self._limit = limit_args(limit[0] if len(limit) == 1 else limit)
+        return self
+
+    def compile(self):
+        """
+        :return: ``tuple`` (sql, args)
+        """
+        limit = self._limit
+        sql = compile_select(self._select, self._where, self._orderby, len(limit))
+        return sql, (self._args + limit) if limit else self._args
+
+    async def all(self, compact=False):
+        limit = self._limit
+        sql = compile_select(self._select, self._where, self._orderby, len(limit))
+        rs = await select(sql, (self._args + limit) if limit else self._args, kind=TUPLE)
+        if compact:
+            return list(map(self.model.__row__.maker(selected_columns(self.model, self._unloaded)), rs))
+        return self.model.from_tuples(rs, self._unloaded)
+
+    async def iter(self, chunk=500):
+        """ 逐行迭代结果，见Model.iter_all() """
+        sql, args = self.compile()
+        async for rows in select_iter(sql, args, chunk):
+            for instance in self.model.from_rows(rows, self._unloaded):
+                yield instance
+
+    async def first(self):
+        sql, args = self.limit(1).compile()
+        rs = await select(sql, args, 1)
+        if len(rs) == 0:
+            return None
+        return self.model.from_rows(rs, self._unloaded)[0]
+
+    def prepare(self):
+        """
+        编译好的查询，可以保存在模块级变量中重复使用，见PreparedQuery
+        :return: ``PreparedQuery``
+        """
+        sql, args = self.compile()
+        return PreparedQuery(self.model, sql, args, self._unloaded)
+
+
+class PreparedQuery(object):
+    """
+    Query.prepare()编译好的查询。SQL语句固定，每次调用按占位符的顺序传入全部参数（包括limit的参数），
+    不传参数时使用构造查询时的参数。
+    条件的形状在prepare()时就确定了：== None编译成is null，in_()的占位符个数取决于当时传入的值的个数。
+    """
+    __slots__ = ('model', 'sql', 'args', 'unloaded')
+
+    def __init__(self, model, sql, args, unloaded):
+        self.model = model
+        self.sql = sql
+        self.args = args
+        self.unloaded = unloaded
+
+    async def all(self, *args, compact=False):
+        """
+        :param args: 占位符的参数，个数必须和构造查询时相同
+        :param compact: ``bool`` 返回紧凑的只读行，见Row
+        :return: ``list``
+        """
+        if not args:
+            args = self.args
+        elif len(args) != len(self.args):
+            raise ValueError('Expected %d arguments, got %d: %s' % (len(self.args), len(args), self.sql))
+        rs = await select(self.sql, args, kind=TUPLE)
+        if compact:
+            return list(map(self.model.__row__.maker(selected_columns(self.model, self.unloaded)), rs))
+        return self.model.from_tuples(rs, self.unloaded)
+
+    def __str__(self):
+        return '<PreparedQuery %s>' % self.sql
+
+
+@functools.lru_cache(maxsize=256)
+def compile_projection(model, columns):
+    """
+    只查询主键和部分字段的SELECT语句，按(模型, 字段)缓存
+    :param model: Model的子类
+    :param columns: ``tuple`` 字段名
+    :return: ``tuple`` (SELECT语句, 没有加载的字段)
+    """
+    for c in columns:
+        if c not in model.__mappings__:
+            raise ValueError('Invalid column: %s' % c)
+    columns = tuple(f for f in model.__fields__ if f in columns)
+    sql = 'select `%s`%s from `%s`' % (model.__primary_key__, ''.join(', `%s`' % f for f in columns), model.__table__)
+    return sql, tuple(f for f in model.__fields__ if f not in columns)
+
+
+@functools.lru_cache(maxsize=256)
+def selected_columns(model, unloaded):
+    """
+    :param model: Model的子类
+    :param unloaded: ``tuple`` 查询中没有读取的字段
+    :return: ``tuple`` projection()生成的SELECT语句中各字段的顺序，按(模型, 没有读取的字段)缓存
+    """
+    if not unloaded:
+        return model.__names__
+    return (model.__primary_key__,) + tuple(f for f in model.__fields__ if f not in unloaded)
+
+
+@functools.lru_cache(maxsize=256)
+def compile_update(table, primary_key, columns):
     """
+    只更新部分字段的UPDATE语句，按(表, 字段)缓存
+    """
+    sql = 'update `%s` set %s where `%s`=?' % (table, ', '.join('`%s`=?' % f for f in columns), primary_key)
+    translate(sql)
+    return sql
 
-    :param sql:``str`` 执行的sql语句
-    :param args:``tuple`` SQL参数
-    :return:
+
+class Deferred(object):
     """
-    logging.info('sql:%s' % sql)
+    延迟加载
 
+    findall()等列表查询不读取声明了deferred=True的字段（如Blog.content），也可以用columns参数只读取部分字段。
+    同一次查询得到的实例共享一个Deferred，记录它们还没有加载的字段。对其中任意一个实例调用await instance.load()时，
+    用一条 select `pk`, ... where `pk` in (...) 为整组实例加载这些字段：
 
-# 创建连接池
-async def create_pool(loop, **kwargs):
+    blogs = await Blog.findall()          # 不读取content
+    await blogs[0].load('content')        # 一次查询为所有blogs加载content
+
+    没有加载的字段不在实例中，访问时和其他不存在的属性一样抛出AttributeError；update()不会写这些字段。
     """
-    我们需要创建一个全局的连接池，每个HTTP请求都可以从连接池中直接获取数据库连接。使用连接池的好处是不必频繁地打开和关闭数据库连接，
-    而是能复用就尽量复用。连接池由全局变量__pool存储，缺省情况下将编码设置为utf8，自动提交事务：
-    :param loop:
-    :param kwargs:
-    :return:
+
+    def __init__(self, model, instances, unloaded):
+        self.model = model
+        self.instances = instances
+        self.unloaded = set(unloaded)
+        self._lock = None
+
+    async def load(self, columns=None):
+        """
+        :param columns: ``list`` 要加载的字段，None表示所有没有加载的字段
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            columns = tuple(c for c in (columns or self.model.__fields__) if c in self.unloaded)
+            if not columns:
+                return
+            pk = self.model.__primary_key__
+            sql, _ = compile_projection(self.model, columns)
+            instances = {i[pk]: i for i in self.instances}
+            for batch in batches(list(instances.keys()), 500):
+                for r in await select(compile_find_many(sql, pk, len(batch)), batch):
+                    instance = instances.get(r[pk])
+                    if instance is not None:
+                        for c in columns:
+                            dict.__setitem__(instance, c, r[c])
+            self.unloaded.difference_update(columns)
+
+
+class LRUCache(object):
     """
-    logging.info('create database connection pool...')
-    global __pool
-    __pool = await aiomysql.create_pool(
-        host=kwargs.get('host', 'localhost'),
-        port=kwargs.get('port', 3306),
-        user=kwargs.get('user'),
-        password=kwargs['password'],
-        db=kwargs['db'],
-        charset=kwargs.get('charset', 'utf8'),
-        autocommit=kwargs.get('autocommit', True),
-        maxsize=kwargs.get('maxsize', 10),
-        minsize=kwargs.get('minsize', 1),
-        loop=loop
-    )
+    按主键缓存行数据的LRU缓存，条目超过ttl秒后过期。在Model子类中声明__cache__即可为find()开启缓存：
 
+    class User(Model):
+        __table__ = 'users'
+        __cache__ = LRUCache(maxsize=1000, ttl=60)
 
-# Select
-async def select(sql, args, size=None):
+    键是loose_key()转换后的主键。save()、update()、remove()会让对应主键的条目失效。stats()返回命中、未命中和淘汰的次数，用来确定缓存大小。
     """
-    要执行SELECT语句，我们用select函数执行，需要传入SQL语句和SQL参数：
-    :param sql: ``str`` SQL语句
-    :param args: ``tuple`` SQL参数
-    :param size:``int`` number of rows to return. 如果传入size参数，就通过fetchmany()获取最多指定数量的记录，否则，通过fetchall()获取所有记录。
-    :return:``list`` of fetched rows
+
+    def __init__(self, maxsize=1000, ttl=60):
+        """
+        :param maxsize: ``int`` 最多缓存的条目数
+        :param ttl: ``float`` 条目的有效期（秒），None表示永不过期
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        # 每次失效都加1，find()查询数据库期间如果发生了失效，就不再把查到的旧数据放进缓存
+        self.version = 0
+        self._data = OrderedDict()
+
+    def get(self, key):
+        """
+        :return: ``dict`` 缓存的行数据，不存在或已过期时返回None
+        """
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires, row = entry
+        if expires is not None and expires < time.monotonic():
+            del self._data[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return row
+
+    def put(self, key, row):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._data[key] = (expires, row)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        self.version += 1
+        self._data.pop(key, None)
+
+    def clear(self):
+        self.version += 1
+        self._data.clear()
+
+    def stats(self):
+        return dict(size=len(self._data), maxsize=self.maxsize, hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, expirations=self.expirations)
+
+
+@functools.lru_cache(maxsize=256)
+def compile_find_many(select, primary_key, num):
     """
-    log(sql, args)
-    global __pool
-    async with __pool.get() as conn:
-        # 创建一个DictCursor类指针，返回dict形式的结果集
-        # 以上下文方式创建cur指针，无需再调用cur.close()
-        # print(__pool)
-        async with conn.cursor(aiomysql.DictCursor) as cur:
-            # SQL语句的占位符是?，而MySQL的占位符是 % s，select() 函数在内部自动替换。
-            # 注意要始终坚持使用带参数的SQL，而不是自己拼接SQL字符串，这样可以防止SQL注入攻击。
-            print(sql.replace('?', '%s'))
-            await cur.execute(sql.replace('?', '%s'), args or ())
-            if size:
-                result = await cur.fetchmany(size)
-            else:
-                result = await cur.fetchall()
-        logging.info('rows returned: %s' % len(result))
-        return result
+    按主键批量查询的SELECT语句：select ... where `pk` in (?, ?, ...)，结果按(语句, 主键个数)缓存
+    """
+    return compile_select(select, '`%s` in (%s)' % (primary_key, create_args_string(num)))
 
 
-# Insert, Update, Delete
-# 要执行INSERT、UPDATE、DELETE语句，可以定义一个通用的execute()函数，因为这3种SQL的执行都需要相同的参数，以及返回一个整数表示影响的行数：
-async def execute(sql, args, autocommit=True):
-    """Executes the given Insert, Update or Delete operation
+def loose_key(pk):
+    """
+    :return: ``str`` 忽略类型、大小写和末尾空格的主键，SQL中相等的主键这里也相等
+    """
+    return str(pk).rstrip().casefold()
 
-        Executes the given operation substituting any markers with
-        the given parameters.
 
-        For example, getting all rows where id is 5:
-          cursor.execute("INSERT INTO Websites (name, url, alexa, country) VALUES (%s,%s,%s,%s)",
-          ('百度','https://www.baidu.com/','4','CN'))
+class Batch(object):
+    """
+    BatchLoader的一批主键。deadline是等待者中最晚的截止时间，有等待者不限时间时为None；
+    waiters为还在等待结果的调用者个数，都放弃（超时或被取消）后批量查询也被取消
+    """
+    __slots__ = ('futures', 'waiters', 'deadline', 'task')
 
-    :param sql: ``str`` sql statement
-    :param args: ``tuple`` or ``list`` of arguments for sql query
-    :param autocommit:``bool``, toggle autocommit
-    :return: ``int``, number of rows that has been produced of affected
+    def __init__(self, at):
+        self.futures = dict()
+        self.waiters = 0
+        self.deadline = at
+        self.task = None
+
+    def join(self, at):
+        if self.deadline is not None and (at is None or at > self.deadline):
+            self.deadline = at
+
+
+class BatchLoader(object):
+    """
+    把并发的find()调用合并成一条 select ... where `pk` in (...) 查询。
+
+    同一轮事件循环（或window秒内）中各个协程请求的主键先登记到当前的Batch，到期后由一个任务统一查询，
+    再把每一行分发给等待它的Future。例如渲染评论作者时：
+    users = await asyncio.gather(*[User.find(c.user_id) for c in comments])
+    只会占用一个连接、执行一次查询。ModelMetaclass为每个Model创建默认的BatchLoader，声明__loader__ = None可以关闭。
+    批量查询在空的Context中执行，不继承第一个调用者的状态，截止时间取所有等待者中最晚的一个；
+    每个调用者按自己的截止时间等待结果，所有调用者都放弃后取消批量查询，中断正在执行的语句并归还连接。
     """
-    log(sql)
-    global __pool
-    async with __pool.get() as pool_connect:
-        if not autocommit:
-            pool_connect.begin()
-        try:
-            async with pool_connect.cursor(aiomysql.DictCursor) as pool_cur:
-                await pool_cur.execute(sql.replace('?', '%s'), args)
-                rows_affected = pool_cur.rowcount  # Returns the number of rows that has been produced of affected.
-        except Exception as e:
-            if not autocommit:
-                await pool_connect.rollback()
-            raise Exception(e)
-        return rows_affected
 
-"""
-ORM
+    def __init__(self, window=0, max_batch=100):
+        """
+        :param window: ``float`` 收集主键的时间窗口（秒），0表示只合并同一轮事件循环中的调用
+        :param max_batch: ``int`` 一条查询最多包含的主键个数，攒够后立即查询
+        """
+        self.window = window
+        self.max_batch = max_batch
+        self.model = None
+        self._batch = None
 
-有了基本的select()和execute()函数，我们就可以开始编写一个简单的ORM了。
-设计ORM需要从上层调用者角度来设计。
-我们先考虑如何定义一个User对象，然后把数据库表users和它关联起来。
+    def bind(self, model):
+        self.model = model
 
-from orm import Model, StringField, IntegerField
+    async def load(self, pk):
+        """
+        :param pk: 主键
+        :return: ``dict`` 行数据，不存在时为None
+        """
+        # 先检查截止时间，已经超时时不登记主键
+        timeout = remaining()
+        at = _deadline.get()
+        batch = self._batch
+        loop = asyncio.get_event_loop()
+        if batch is None:
+            batch = self._batch = Batch(at)
+            # 批量查询替所有调用者执行，在空的Context中调度，不继承第一个调用者的截止时间等状态
+            if self.window:
+                loop.call_later(self.window, self._dispatch, batch, context=contextvars.Context())
+            else:
+                loop.call_soon(self._dispatch, batch, context=contextvars.Context())
+        else:
+            batch.join(at)
+        future = batch.futures.get(pk)
+        if future is None:
+            future = batch.futures[pk] = loop.create_future()
+            if len(batch.futures) >= self.max_batch:
+                self._dispatch(batch)
+        batch.waiters += 1
+        try:
+            # shield: 一个调用者被取消或超时时，不影响等待同一个Future的其他协程
+            return await within(asyncio.shield(future), timeout)
+        finally:
+            batch.waiters -= 1
+            if not batch.waiters and batch.task is not None:
+                batch.task.cancel()
+
+    def _dispatch(self, batch):
+        if batch is not self._batch:
+            return
+        self._batch = None
+        if not batch.waiters:
+            return
+        batch.task = contextvars.Context().run(asyncio.get_event_loop().create_task, self._fetch(batch))
+
+    async def _fetch(self, batch):
+        if batch.deadline is not None:
+            # 任务在自己的空Context中运行，这里设置的截止时间只影响批量查询
+            _deadline.set(batch.deadline)
+        pending = batch.futures
+        model = self.model
+        pks = list(pending.keys())
+        try:
+            rs = await select(compile_find_many(model.__select__, model.__primary_key__, len(pks)), pks)
+        except Exception as e:
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        rows = {r[model.__primary_key__]: r for r in rs}
+        loose = {loose_key(k) for k in rows}
+        for pk, future in pending.items():
+            if future.done():
+                continue
+            row = rows.get(pk)
+            if row is None and loose_key(pk) in loose:
+                # 数据库按SQL的规则比较主键（123 = '123'、大小写不敏感的排序规则），返回的行和请求的主键在Python中可能不相等，
+                # 宽松比较能对上时，用__find__单独查询这个主键，结果和直接查询相同
+                try:
+                    rs = await select(model.__find__, [pk], 1)
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                    continue
+                row = rs[0] if rs else None
+            if not future.done():
+                future.set_result(row)
+
+
+class WriteBehind(object):
+    """
+    延迟写入。模型声明了__write_behind__后，save()把行放进进程内的队列就返回，由后台任务攒成多行INSERT批量写入：
 
-class User(Model):
-    __table__ = 'users'
+    class Comment(Model):
+        __write_behind__ = WriteBehind(max_batch=100, interval=0.05)
 
-    id = IntegerField(primary_key=True)
-    name = StringField()
+    await comment.save()              # 放进队列，不等待数据库
+    await comment.save(wait=True)     # 等到这一行写入数据库
+    future = await comment.save()     # 稍后await future
 
-注意到定义在User类中的__table__、id和name是类的属性，不是实例的属性。
-所以，在类级别上定义的属性用来描述User对象和表的映射关系，而实例属性必须通过__init__()方法去初始化，所以两者互不干扰：
+    攒够max_batch行或者等待interval秒后写一批；队列满（maxsize行）时save()等待，形成背压。
+    写入前其他请求查不到这些行；事务中的save()直接写入。close_pool()关闭连接池前写完所有队列。
+    """
 
-# 创建实例:
-user = User(id=123, name='Michael')
-# 存入数据库:
-user.insert()
-# 查询所有User对象:
-users = User.findAll()
-"""
+    def __init__(self, max_batch=100, interval=0.05, maxsize=10000):
+        """
+        :param max_batch: ``int`` 一条INSERT语句最多的行数
+        :param interval: ``float`` 第一行进入队列后最多等待的秒数
+        :param maxsize: ``int`` 队列的容量，满了之后save()等待
+        """
+        self.max_batch = max_batch
+        self.interval = interval
+        self.maxsize = maxsize
+        self.model = None
+        self._queue = None
+        self._full = None
+        self._task = None
+
+    def bind(self, model):
+        self.model = model
+        write_behinds.append(self)
+
+    async def put(self, instance):
+        """
+        :param instance: 要插入的实例，在这里填充默认值（如主键）
+        :return: ``Future`` 这一行写入数据库后完成
+        """
+        if self._queue is None:
+            self._queue = asyncio.Queue(self.maxsize)
+            self._full = asyncio.Event()
+        if self._task is None or self._task.done():
+            # 后台任务不能继承请求的上下文（事务、截止时间等），在空的上下文中创建
+            self._task = contextvars.Context().run(asyncio.ensure_future, self._run())
+        future = asyncio.get_event_loop().create_future()
+        await self._queue.put((instance, instance.insert_args(), future))
+        if self._queue.qsize() >= self.max_batch:
+            self._full.set()
+        return future
+
+    async def _run(self):
+        queue = self._queue
+        while True:
+            batch = [await queue.get()]
+            if queue.qsize() + 1 < self.max_batch:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._full.clear()
+            while len(batch) < self.max_batch and not queue.empty():
+                batch.append(queue.get_nowait())
+            try:
+                await self._write(batch)
+            finally:
+                for _ in batch:
+                    queue.task_done()
+
+    async def _write(self, batch):
+        model = self.model
+        try:
+            args = []
+            for instance, a, future in batch:
+                args.extend(a)
+            await execute(compile_insert_many(model.__insert__, len(batch)), args)
+            results = [None] * len(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                results = [e]
+            else:
+                # 整批失败时逐行重试，一行出错不影响其他行
+                logging.warning('write-behind batch of %s failed, retrying row by row: %s' % (len(batch), e))
+                results = []
+                for instance, a, future in batch:
+                    try:
+                        await execute(model.__insert__, a)
+                        results.append(None)
+                    except Exception as e:
+                        results.append(e)
+        model.invalidate(*(instance.get_value(model.__primary_key__) for instance, a, future in batch))
+        for (instance, a, future), error in zip(batch, results):
+            if error is None:
+                object.__setattr__(instance, '_dirty', ())
+                if not future.done():
+                    future.set_result(True)
+            else:
+                logging.error('write-behind insert into %s failed: %s' % (model.__table__, error))
+                if not future.done():
+                    future.set_exception(error)
+                    # 错误已经记录了日志；不等待结果的调用者不会再看到"Future exception was never retrieved"
+                    future.exception()
 
+    async def flush(self):
+        """
+        等到队列中的行全部写入
+        """
+        if self._queue is not None:
+            await self._queue.join()
 
-# Field和各种Field子类，用于映射各种数据字段：
-class Field(object):
-    def __init__(self, name, column_type, primary_key, default):
+    async def close(self):
         """
-        各种数据字段的基类
-        :param name:``str``字段名称
-        :param column_type:``str`` the type of field
-        :param primary_key:``bool`` 是否为主键
-        :param default:
+        写完队列后停止后台任务
         """
-        self.name = name
-        self.column_type = column_type
-        self.primary_key = primary_key
-        self.default = default
+        await self.flush()
+        if self._task is not None:
+            self._task.cancel()
+        self._queue, self._full, self._task = None, None, None
 
-    def __str__(self):
-        return '<%s, %s:%s>' % (self.__class__.__name__, self.column_type, self.name)
 
-    def __getattr__(self, item):
-        for item in ['name', 'column_type', 'primary_key', 'default']:
-            return self[item]
+# 所有模型的WriteBehind，close_pool()时逐个写完
+write_behinds = []
 
 
-def create_args_string(num):
+async def flush_writes():
     """
-    create args string
-    :param num: ``int`` the number of args
-    :return:``list'' of args of string
+    写完所有模型的延迟写入队列
     """
-    L = []
-    for n in range(num):
-        L.append('?')
-    return ', '.join(L)
+    for write_behind in write_behinds:
+        await write_behind.close()
 
 
-# BIGINT 8 字节 	(-9 233 372 036 854 775 808，9 223 372 036 854 775 807) 	(0，18 446 744 073 709 551 615) 	极大整数值
-class IntegerField(Field):
-    def __init__(self, name=None, primary_key=False, default=0):
-        super().__init__(name, 'bigint', primary_key, default)
+try:
+    # namedtuple使用的C描述符，直接按位置读tuple的元素，不经过Row.__getitem__
+    from _collections import _tuplegetter
+except ImportError:
+    def _tuplegetter(index, doc):
+        return property(lambda self: tuple.__getitem__(self, index), doc=doc)
 
 
-# VARCHAR 	0-65535 字节 	变长字符串
-class StringField(Field):
-    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)'):
-        super().__init__(name, ddl, primary_key, default)
+class Row(tuple):
+    """
+    紧凑的只读行。ModelMetaclass为每个Model生成一个Row子类（Model.__row__）：tuple的子类，按_fields的顺序保存各个字段，
+    和namedtuple一样每个字段是一个按位置取值的描述符，没有实例字典，比Model(dict)实例小得多，属性访问也更快。
+    由TUPLE游标返回的一行直接用tuple.__new__生成，见maker()。findall(compact=True)返回这种行：
 
+    blogs = await Blog.findall(orderBy='created_at desc', compact=True)
+    blogs[0].name, blogs[0]['name'], blogs[0]._asdict()
 
-# BOOL / BOOLEAN 布尔类型
-class BooleanField(Field):
-    def __init__(self, name=None, default=None):
-        super().__init__(name, 'boolean', False, default)
+    支持属性访问和按字段名的下标访问，可以直接用在模板中；json.dumps会把tuple序列化成数组，JSON响应中先用_asdict()转成dict。
+    """
+    __slots__ = ()
+    _fields = ()
+    _index = {}
 
+    def __new__(cls, row):
+        """
+        :param row: ``dict`` DictCursor返回的一行，没有的字段为None
+        """
+        return tuple.__new__(cls, [row.get(name) for name in cls._fields])
 
-# REAL就是DOUBLE ，如果SQL服务器模式包括REAL_AS_FLOAT选项，REAL是FLOAT的同义词而不是DOUBLE的同义词。
-class FloatField(Field):
-    def __init__(self, name=None, primary_key=False, default=0.0):
-        super().__init__(name, 'real', primary_key, default)
+    @classmethod
+    def maker(cls, names):
+        """
+        :param names: ``tuple`` TUPLE游标返回的各列的字段名，见selected_columns()
+        :return: 由一行的值生成Row的函数，没有查询的字段为None；按names缓存在类上
+        """
+        make = cls._makers.get(names)
+        if make is None:
+            if names == cls._fields:
+                make = functools.partial(tuple.__new__, cls)
+            else:
+                # 没有查询的字段取values后面补上的None
+                pad = (None,)
+                positions = [names.index(f) if f in names else len(names) for f in cls._fields]
+                # 只有一个字段时itemgetter返回的不是tuple
+                getter = operator.itemgetter(*positions) if len(positions) > 1 else lambda v: (v[positions[0]],)
+                new = tuple.__new__
+
+                def make(values):
+                    return new(cls, getter(values + pad))
+            cls._makers[names] = make
+        return make
 
+    @classmethod
+    def _make(cls, names, values):
+        """
+        由TUPLE游标返回的一行生成，没有查询的字段为None
+        :param names: ``tuple`` 字段名，与values一一对应
+        :param values: ``tuple`` 一行的值
+        """
+        return cls.maker(names)(values)
 
-# text 	string长度+2字节 	字符串，最大长度为0-65535个字节
-class TextField(Field):
-    def __init__(self, name=None, default=None):
-        super().__init__(name, 'text', False, default)
+    def __setattr__(self, key, value):
+        raise AttributeError(r"'%s' object is read-only" % self.__class__.__name__)
+
+    def __delattr__(self, key):
+        raise AttributeError(r"'%s' object is read-only" % self.__class__.__name__)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            try:
+                key = self._index[key]
+            except KeyError:
+                raise KeyError(key) from None
+        return tuple.__getitem__(self, key)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __eq__(self, other):
+        if isinstance(other, Row):
+            return self._fields == other._fields and tuple.__eq__(self, other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        if isinstance(other, Row):
+            return not self == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def get(self, key, default=None):
+        i = self._index.get(key)
+        if i is None:
+            return default
+        return tuple.__getitem__(self, i)
+
+    def keys(self):
+        return self._fields
+
+    def _asdict(self):
+        return dict(zip(self._fields, self))
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self._asdict())
+
+
+def row_class(name, fields):
+    """
+    :param name: ``str`` 类名
+    :param fields: ``tuple`` 字段名，主键在前
+    :return: Row的子类，每个字段是一个按位置取值的描述符
+    """
+    attrs = dict(__slots__=(), _fields=fields, _index={f: i for i, f in enumerate(fields)}, _makers=dict())
+    for i, f in enumerate(fields):
+        attrs[f] = _tuplegetter(i, 'Alias for field number %d' % i)
+    return type(name, (Row,), attrs)
 
 
 class ModelMetaclass(type):
@@ -214,6 +1789,13 @@ class ModelMetaclass(type):
         table_name = attrs.get('__table__', None) or name
         logging.info('found model: %s (table: %s)' % (name, table_name))
 
+        # 取出关系声明，见Relation
+        relations = dict()
+        for k, v in list(attrs.items()):
+            if isinstance(v, Relation):
+                v.name = k
+                relations[k] = attrs.pop(k)
+
         # 获取所有的属性名和主键名:
         mappings = dict()
         fields = []
@@ -234,9 +1816,16 @@ class ModelMetaclass(type):
         # 没有找到主键
         if not primary_key:
             raise Exception('Primary key not found.')
-        # 清空属性字典中已找到的Field
+        # 清空属性字典中已找到的Field，换成查询构造器使用的Column描述符
+        # 与dict或Model已有属性同名的字段不生成描述符，以免覆盖原有方法
+        columns = dict()
         for k in mappings.keys():
             attrs.pop(k)
+            columns[k] = Column(k)
+            if any(hasattr(b, k) for b in bases):
+                logging.warning('field %s shadows an attribute of %s, no column descriptor created' % (k, name))
+            else:
+                attrs[k] = columns[k]
 
         # 把fields列表中的内容添加``后映射到escaped_fields列表中
         # 反引号``区分MYSQL的保留字与普通字符而引入的符号,如果`select`字段，不用反引号，MYSQL将把select视为保留字而导致出错
@@ -247,18 +1836,58 @@ class ModelMetaclass(type):
         attrs['__table__'] = table_name  # 假设表名和类名一致
         attrs['__primary_key__'] = primary_key   # 主键属性名
         attrs['__fields__'] = fields  # 除主键外的属性名
+        attrs['__names__'] = (primary_key,) + tuple(fields)  # __select__中各字段的顺序
+        attrs['__columns__'] = columns  # 属性名到Column的映射
+        attrs['__row__'] = row_class('%sRow' % name, (primary_key,) + tuple(fields))  # 紧凑的只读行
+        attrs.setdefault('__cache__', None)  # find()的主键缓存，默认不开启
+        attrs.setdefault('__write_behind__', None)  # save()的延迟写入，默认不开启
+        # 合并字段上声明的索引和__indexes__中声明的组合索引
+        indexes = [Index(k, unique=v.unique) for k, v in mappings.items() if (v.index or v.unique) and not v.primary_key]
+        indexes.extend(attrs.get('__indexes__', ()))
+        for index in indexes:
+            for c in index.columns:
+                if c not in mappings:
+                    raise Exception('Index column not found: %s' % c)
+        attrs['__indexes__'] = tuple(index.bind(table_name) for index in indexes)
+        for k, v in relations.items():
+            if v.column not in mappings:
+                raise Exception('Relation column not found: %s' % v.column)
+        attrs['__relations__'] = relations
+        if '__count_cache__' not in attrs:
+            attrs['__count_cache__'] = LRUCache(maxsize=256, ttl=60)  # findNumber()的结果缓存
+        if '__loader__' not in attrs:
+            attrs['__loader__'] = BatchLoader()  # 合并并发的find()
 
         # 构造默认的SELECT, INSERT, UPDATE和DELETE语句:
 
         attrs['__select__'] = 'select `%s`, %s from `%s`' % (primary_key, ', '.join(escaped_fields), table_name)
+        # 列表查询使用的SELECT语句，不包括延迟加载的字段
+        deferred = tuple(k for k in fields if mappings[k].deferred)
+        attrs['__deferred__'] = deferred
+        attrs['__select_list__'] = 'select `%s`%s from `%s`' % (
+            primary_key, ''.join(', `%s`' % f for f in fields if f not in deferred), table_name)
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (
             table_name, ', '.join(escaped_fields),
             primary_key, create_args_string(len(escaped_fields) + 1))
         attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (
             table_name, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primary_key)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (table_name, primary_key)
+        attrs['__find__'] = compile_select(attrs['__select__'], '`%s`=?' % primary_key)
+        # 预先转换占位符，select()和execute()执行时直接命中缓存
+        for sql in ('__select__', '__select_list__', '__insert__', '__update__', '__delete__', '__find__'):
+            translate(attrs[sql])
         # print(attrs.items())
-        return type.__new__(mcs, name, bases, attrs)
+        cls = type.__new__(mcs, name, bases, attrs)
+        if cls.__loader__ is not None:
+            cls.__loader__.bind(cls)
+        if cls.__write_behind__ is not None:
+            cls.__write_behind__.bind(cls)
+        models[name] = cls
+        return cls
+
+
+# 类名到Model子类的映射，Relation用类名查找关联的类
+models = dict()
 
 
 class Model(dict, metaclass=ModelMetaclass):
@@ -282,8 +1911,24 @@ class Model(dict, metaclass=ModelMetaclass):
     往Model类添加实例方法，就可以让所有子类调用实例方法：
     """
 
+    # 同一次查询得到的实例共享的延迟加载信息，见Deferred
+    _deferred = None
+    # 从数据库读出（或者save()/update()之后）被修改过的字段。类属性()表示没有修改；
+    # 直接构造的实例为None，不跟踪修改，update()写所有字段
+    _dirty = ()
+
     def __init__(self, **kw):
         super(Model, self).__init__(**kw)
+        object.__setattr__(self, '_dirty', None)
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        dirty = self._dirty
+        if dirty is not None:
+            if type(dirty) is set:
+                dirty.add(key)
+            else:
+                object.__setattr__(self, '_dirty', {key})
 
     def __getattr__(self, key):
         try:
@@ -307,42 +1952,269 @@ class Model(dict, metaclass=ModelMetaclass):
                 setattr(self, key, value)
         return value
 
+    def insert_args(self):
+        args = list(map(self.get_value_or_default, self.__fields__))
+        args.append(self.get_value_or_default(self.__primary_key__))
+        return args
+
+    def update_statement(self):
+        """
+        从数据库读出的实例只写被修改过的字段（没有加载的字段自然也不写），UPDATE语句按字段组合缓存；
+        直接构造的实例写所有字段
+        :return: ``tuple`` (UPDATE语句, 参数)，没有需要写的字段时为(None, None)
+        """
+        dirty = self._dirty
+        if dirty is None:
+            columns, sql = self.__fields__, self.__update__
+        else:
+            columns = tuple(f for f in self.__fields__ if f in dirty)
+            if not columns:
+                return None, None
+            sql = compile_update(self.__table__, self.__primary_key__, columns)
+        args = list(map(self.get_value, columns))
+        args.append(self.get_value(self.__primary_key__))
+        return sql, args
+
+    def unloaded(self):
+        """
+        :return: ``tuple`` 延迟加载、还没有加载的字段
+        """
+        if self._deferred is None:
+            return ()
+        unloaded = self._deferred.unloaded
+        return tuple(f for f in self.__fields__ if f in unloaded)
+
+    async def load(self, *columns):
+        """
+        加载延迟加载的字段，同一次查询得到的实例一起加载，见Deferred
+        :param columns: ``str`` 字段名，不指定时加载所有没有加载的字段
+        """
+        if self._deferred is not None:
+            await self._deferred.load(columns or None)
+
+    @classmethod
+    def from_row(cls, row):
+        """
+        由一行查询结果生成实例，不调用__init__，实例从这里开始跟踪修改
+        :param row: ``dict``
+        """
+        instance = dict.__new__(cls)
+        dict.update(instance, row)
+        return instance
+
+    @classmethod
+    def from_rows(cls, rs, unloaded=()):
+        """
+        由查询结果生成实例
+        :param rs: ``list`` of ``dict`` 查询结果
+        :param unloaded: ``tuple`` 查询中没有读取的字段
+        :return: ``list`` 实例列表
+        """
+        instances = list(map(cls.from_row, rs))
+        if unloaded and instances:
+            deferred = Deferred(cls, instances, unloaded)
+            for instance in instances:
+                object.__setattr__(instance, '_deferred', deferred)
+        return instances
+
+    @classmethod
+    def from_tuples(cls, rs, unloaded=()):
+        """
+        由TUPLE游标的查询结果生成实例。projection()的SELECT语句按主键、__fields__中除unloaded以外的字段排列，
+        每行按这个顺序直接填进实例，驱动不用先为每行构造一个dict
+        :param rs: ``list`` of ``tuple`` 查询结果
+        :param unloaded: ``tuple`` 查询中没有读取的字段
+        :return: ``list`` 实例列表
+        """
+        names = selected_columns(cls, unloaded)
+        new, update = dict.__new__, dict.update
+        instances = []
+        for r in rs:
+            instance = new(cls)
+            update(instance, zip(names, r))
+            instances.append(instance)
+        if unloaded and instances:
+            deferred = Deferred(cls, instances, unloaded)
+            for instance in instances:
+                object.__setattr__(instance, '_deferred', deferred)
+        return instances
+
+    @classmethod
+    def projection(cls, columns=None):
+        """
+        :param columns: ``list`` 要查询的字段，None表示除延迟加载字段以外的所有字段
+        :return: ``tuple`` (SELECT语句, 没有读取的字段)
+        """
+        if columns is None:
+            return cls.__select_list__, cls.__deferred__
+        return compile_projection(cls, tuple(columns))
+
+    @classmethod
+    def ddl(cls, options=''):
+        """
+        由__mappings__生成CREATE TABLE语句
+        :param options: ``str`` 表选项，如MySQL的engine=innodb default charset=utf8
+        :return: ``str``
+        """
+        columns = ['`%s` %s' % (cls.__primary_key__, cls.__mappings__[cls.__primary_key__].column_type)]
+        columns.extend('`%s` %s' % (f, cls.__mappings__[f].column_type) for f in cls.__fields__)
+        columns.append('primary key (`%s`)' % cls.__primary_key__)
+        return 'create table if not exists `%s` (\n  %s\n)%s' % (
+            cls.__table__, ',\n  '.join(columns), ' ' + options if options else '')
+
+    @classmethod
+    def index_ddl(cls, index):
+        """
+        :param index: ``Index``
+        :return: ``str`` CREATE INDEX语句
+        """
+        return 'create %sindex `%s` on `%s` (%s)' % (
+            'unique ' if index.unique else '', index.name, cls.__table__, ', '.join('`%s`' % c for c in index.columns))
+
+    @classmethod
+    def where(cls, *conditions):
+        """
+        创建查询，例如Blog.where(Blog.user_id == uid).order_by(Blog.created_at.desc()).all()
+        :param conditions: ``Condition`` 用and连接的查询条件
+        :return: ``Query``
+        """
+        return Query(cls, conditions)
+
+    @classmethod
+    async def prefetch(cls, instances, *paths):
+        """
+        为instances加载关联的行，每个关系一条查询，见Relation：
+        comments = await Comment.findall('`blog_id`=?', [blog_id])
+        await Comment.prefetch(comments, 'user')
+        :param instances: ``list`` 本表的实例
+        :param paths: ``str`` 关系名，或者'blog.user'这样逐层加载的路径
+        """
+        if not instances:
+            return
+        nested = dict()
+        for path in paths:
+            name, _, rest = path.partition('.')
+            if name not in cls.__relations__:
+                raise ValueError('Unknown relation for %s: %s' % (cls.__name__, name))
+            nested.setdefault(name, [])
+            if rest:
+                nested[name].append(rest)
+        for name, rest in nested.items():
+            relation = cls.__relations__[name]
+            related = await relation.load(instances)
+            if rest:
+                await relation.model.prefetch(related, *rest)
+
     @classmethod
     async def findall(cls, where=None, args=None, **kw):
-        """ find objects by WHERE clause. """
-        sql = [cls.__select__]
-        if where:
-            sql.append('where')
-            sql.append(where)
-        if args is None:
-            args = []
-        orderby = kw.get('orderBy', None)
-        if orderby is not None:
-            sql.append('order by')
-            sql.append(orderby)
-        limit = kw.get('limit', None)
-        if limit is not None:
-            sql.append('limit')
-            if isinstance(limit, int):
-                sql.append('?')
-                args.append(limit)
-            elif isinstance(limit, tuple) and len(limit) == 2:
-                sql.append('?, ?')
-                args.extend(limit)
-            else:
-                raise ValueError('Invalid limit value: %s' % str(limit))
-        rs = await select(' '.join(sql), args)
+        """
+        find objects by WHERE clause.
+        columns=[...]只查询主键和这些字段；不指定时查询除延迟加载字段以外的所有字段。没有查询的字段可以用load()加载
+        prefetch=[...]批量加载关联的行，见prefetch()
+        """
+        prefetch = kw.get('prefetch', None)
+        if prefetch and kw.get('compact', False):
+            raise ValueError('prefetch is not supported with compact rows')
+        select_list, unloaded = cls.projection(kw.get('columns', None))
+        limit = limit_args(kw.get('limit', None))
+        sql = compile_select(select_list, where, kw.get('orderBy', None), len(limit))
+        args = list(args) if args else []
+        args.extend(limit)
+        rs = await select(sql, args, kind=TUPLE)
+        # compact=True时返回紧凑的只读行，见Row
+        if kw.get('compact', False):
+            return list(map(cls.__row__.maker(selected_columns(cls, unloaded)), rs))
         # 将返回的结果迭代生成类的实例，返回的都是实例对象, 而非仅仅是数据
-        return [cls(**r) for r in rs]
+        instances = cls.from_tuples(rs, unloaded)
+        if prefetch:
+            await cls.prefetch(instances, *prefetch)
+        return instances
+
+    @classmethod
+    async def findpage(cls, where=None, args=None, token=None, size=20, key='created_at', desc=True, columns=None,
+                       prefetch=None):
+        """
+        键集分页：按(key, 主键)排序，用上一页返回的令牌直接定位到下一页，第N页和第1页的代价相同。
+        blogs, token = await Blog.findpage(size=10)
+        blogs, token = await Blog.findpage(size=10, token=token)
+        :param where: ``str`` WHERE子句
+        :param args: ``list`` WHERE子句的参数
+        :param token: ``str`` 上一页返回的令牌，None表示第一页
+        :param size: ``int`` 每页的行数
+        :param key: ``str`` 排序字段
+        :param desc: ``bool`` 是否倒序，默认最新的在前
+        :param columns: ``list`` 要查询的字段，见findall()
+        :param prefetch: ``list`` 要加载的关系，见prefetch()
+        :return: ``tuple`` (实例列表, 下一页的令牌)，没有下一页时令牌为None
+        """
+        if key not in cls.__mappings__:
+            raise ValueError('Invalid page key: %s' % key)
+        select_list, unloaded = cls.projection(columns)
+        if key in unloaded:
+            raise ValueError('Page key not selected: %s' % key)
+        seek, orderby = compile_seek(key, cls.__primary_key__, desc)
+        conditions = (where,) if where else ()
+        args = list(args) if args else []
+        if token is not None:
+            value, pk = decode_page_token(token)
+            # 调用者的WHERE子句里可能有or，加上括号后再和seek条件用and连接
+            conditions = ('(%s)' % where, seek) if where else (seek,)
+            args.extend((value, value, pk))
+        # 多取一行，用来判断是否还有下一页
+        args.append(size + 1)
+        rs = await select(compile_select(select_list, conditions, orderby, 1), args, kind=TUPLE)
+        token = None
+        instances = cls.from_tuples(rs[:size], unloaded)
+        if len(rs) > size:
+            token = encode_page_token([instances[-1][key], instances[-1][cls.__primary_key__]])
+        if prefetch:
+            await cls.prefetch(instances, *prefetch)
+        return instances, token
+
+    @classmethod
+    async def iter_all(cls, where=None, args=None, chunk=500, **kw):
+        """
+        和findall()参数相同，但结果通过服务器端游标按chunk分批读取，逐个生成实例，内存占用与表的大小无关：
+        async for blog in Blog.iter_all(chunk=500):
+            ...
+        """
+        select_list, unloaded = cls.projection(kw.get('columns', None))
+        limit = limit_args(kw.get('limit', None))
+        sql = compile_select(select_list, where, kw.get('orderBy', None), len(limit))
+        args = list(args) if args else []
+        args.extend(limit)
+        compact = kw.get('compact', False)
+        async for rows in select_iter(sql, args, chunk):
+            # 每一批实例共享一个Deferred
+            for instance in ([cls.__row__(r) for r in rows] if compact else cls.from_rows(rows, unloaded)):
+                yield instance
 
     @classmethod
-    async def findNumber(cls, selectField, where=None, args=None):
-        ' find number by select and where. '
-        sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
-        if where:
-            sql.append('where')
-            sql.append(where)
-        rs = await select(' '.join(sql), args, 1)
+    async def findNumber(cls, selectField, where=None, args=None, approximate=False):
+        """
+        find number by select and where.
+        结果按(表版本, selectField, where, args)缓存在__count_cache__中，表没有被写过就直接返回缓存的结果；
+        声明__count_cache__ = None可以关闭缓存。
+        :param approximate: ``bool`` 没有where条件的count(...)直接读information_schema中的表统计信息，
+                            结果是估计值，但不需要扫描整个表
+        """
+        if approximate and not where and selectField.lower().startswith('count(') \
+                and current_backend().approximate_count:
+            rs = await select(compile_table_rows(), [cls.__table__], 1)
+            return rs[0]['_num_'] if rs else None
+        cache = cls.__count_cache__
+        # 事务中可能读到未提交的数据，不使用缓存
+        if cache is not None and _transaction.get() is None:
+            version = table_version(cls.__table__)
+            key = (version, selectField, where, tuple(args) if args else ())
+            rs = cache.get(key)
+            if rs is None:
+                rs = await select(compile_count(cls.__table__, selectField, where), args, 1)
+                # 查询期间表被写过时，结果可能是旧的，不缓存
+                if table_version(cls.__table__) == version:
+                    cache.put(key, rs)
+        else:
+            rs = await select(compile_count(cls.__table__, selectField, where), args, 1)
         if len(rs) == 0:
             return None
         return rs[0]['_num_']
@@ -350,28 +2222,176 @@ class Model(dict, metaclass=ModelMetaclass):
     @classmethod
     async def find(cls, pk):
         """ find object by primary key. """
-        rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
-        if len(rs) == 0:
+        # 事务中可能读到未提交的数据，不使用缓存；事务固定了一个连接，也不参与批量加载
+        # 固定在主库的请求不参与批量加载，批量查询由其他请求发起时会去读副本
+        # 固定在主库的请求可能刚写过这一行，不读缓存（缓存的行可能是从副本读到的旧数据），查到的行仍然放进缓存
+        in_transaction = _transaction.get() is not None
+        pinned = in_transaction or pinned_to_primary()
+        cache = None if in_transaction else cls.__cache__
+        if cache is not None and not pinned:
+            # 缓存的键是loose_key()，和invalidate()使用的主键即使类型、大小写不同也能对上；
+            # 只有缓存的行主键和请求的主键完全相同时才直接返回，其他情况（如find(123)）交给数据库按SQL的规则比较
+            row = cache.get(loose_key(pk))
+            if row is not None and row[cls.__primary_key__] == pk:
+                return cls.from_row(row)
+        if cache is not None:
+            version = cache.version
+        if cls.__loader__ is not None and not pinned:
+            # 每个调用者按自己的截止时间等待，见BatchLoader
+            row = await cls.__loader__.load(pk)
+        else:
+            rs = await select(cls.__find__, [pk], 1)
+            row = rs[0] if rs else None
+        if row is None:
             return None
-        return cls(**rs[0])
+        # 写表后replica_lag秒内，副本可能还没有追上主库，从副本读到的行不放进缓存，否则旧数据会一直留到ttl过期
+        if cache is not None and cache.version == version and (pinned or replica_settled(cls.__table__)):
+            cache.put(loose_key(row[cls.__primary_key__]), row)
+        return cls.from_row(row)
 
-    async def save(self):
-        args = list(map(self.get_value_or_default, self.__fields__))
-        args.append(self.get_value_or_default(self.__primary_key__))
-        rows = await execute(self.__insert__, args)
+    @classmethod
+    def invalidate(cls, *pks):
+        """ 让find()缓存中这些主键的条目失效 """
+        cache = cls.__cache__
+        if cache is not None:
+            for pk in pks:
+                cache.invalidate(loose_key(pk))
+            # 提交前其他协程仍可能读到旧数据并放入缓存，提交后再失效一次
+            tx = _transaction.get()
+            if tx is not None:
+                tx.after_commit(functools.partial(cls.invalidate, *pks))
+
+    async def save(self, wait=False):
+        """
+        插入一行。模型声明了__write_behind__时放进延迟写入的队列，见WriteBehind
+        :param wait: ``bool`` 延迟写入时是否等到这一行写入数据库
+        :return: 延迟写入时返回``Future``，写入后完成
+        """
+        if self.__write_behind__ is not None and _transaction.get() is None:
+            future = await self.__write_behind__.put(self)
+            if wait:
+                await future
+            return future
+        rows = await execute(self.__insert__, self.insert_args())
+        self.invalidate(self.get_value(self.__primary_key__))
+        object.__setattr__(self, '_dirty', ())
         if rows != 1:
             logging.warning('failed to insert record: affected rows: %s' % rows)
 
+    @classmethod
+    async def save_many(cls, models, batch_size=100):
+        """
+        批量插入，每batch_size行合并成一条多行INSERT语句，和save()一样通过get_value_or_default填充默认值
+        :param models: ``list`` of Model
+        :param batch_size: ``int`` 每条INSERT语句的最大行数
+        :return: ``list`` 每批影响的行数
+        """
+        models = list(models)
+        result = []
+        for batch in batches(models, batch_size):
+            args = []
+            for m in batch:
+                args.extend(m.insert_args())
+            rows = await execute(compile_insert_many(cls.__insert__, len(batch)), args)
+            cls.invalidate(*(m.get_value(cls.__primary_key__) for m in batch))
+            for m in batch:
+                object.__setattr__(m, '_dirty', ())
+            if rows != len(batch):
+                logging.warning('failed to insert records: affected rows: %s of %s' % (rows, len(batch)))
+            result.append(rows)
+        return result
+
+    @classmethod
+    async def update_many(cls, models, batch_size=100):
+        """
+        批量按主键更新，每批用executemany在同一个连接上执行，没有修改的实例跳过
+        :param models: ``list`` of Model
+        :param batch_size: ``int`` 每批的行数
+        :return: ``list`` 每批影响的行数
+        """
+        models = list(models)
+        result = []
+        for batch in batches(models, batch_size):
+            # 各实例修改的字段不同，UPDATE语句不同，按语句分组执行
+            statements = OrderedDict()
+            written = []
+            for m in batch:
+                sql, args = m.update_statement()
+                if sql is not None:
+                    statements.setdefault(sql, []).append(args)
+                    written.append(m)
+            rows = 0
+            for sql, seq_of_args in statements.items():
+                rows += await executemany(sql, seq_of_args)
+            cls.invalidate(*(m.get_value(cls.__primary_key__) for m in written))
+            for m in written:
+                object.__setattr__(m, '_dirty', ())
+            if rows != len(written):
+                logging.warning('failed to update by primary key: affected rows: %s of %s' % (rows, len(written)))
+            result.append(rows)
+        return result
+
     async def update(self):
-        args = list(map(self.get_value, self.__fields__))
-        args.append(self.get_value(self.__primary_key__))
-        rows = await execute(self.__update__, args)
+        sql, args = self.update_statement()
+        if sql is None:
+            return
+        rows = await execute(sql, args)
+        self.invalidate(args[-1])
+        object.__setattr__(self, '_dirty', ())
         if rows != 1:
             logging.warning('failed to update by primary key: affected rows: %s' % rows)
 
+    async def upsert(self):
+        """
+        插入，主键已存在时改为更新所有字段，一条语句完成，不需要先find()。
+        MySQL的ON DUPLICATE KEY UPDATE在唯一索引（如User.email）冲突时也会更新，SQLite只按主键判断冲突
+        :return: ``bool`` True表示插入了新行，False表示更新了已有的行
+        """
+        backend = current_backend()
+        if not backend.upsert_rowcount:
+            return (await self.upsert_many([self]))[0]
+        sql = compile_upsert(backend, self.__insert__, self.__primary_key__, tuple(self.__fields__))
+        rows = await execute(sql, self.insert_args())
+        self.invalidate(self.get_value(self.__primary_key__))
+        object.__setattr__(self, '_dirty', ())
+        return rows == 1
+
+    @classmethod
+    async def upsert_many(cls, models, batch_size=100):
+        """
+        批量upsert，每batch_size行合并成一条语句。多行语句的影响行数不能区分每一行，
+        所以每批在事务中先用 select ... for update 锁定并读出已有的主键，再执行upsert
+        :param models: ``list`` of Model
+        :param batch_size: ``int`` 每条语句的最大行数
+        :return: ``list`` of ``bool`` 与models一一对应，True表示插入，False表示更新
+        """
+        backend = current_backend()
+        pk = cls.__primary_key__
+        models = list(models)
+        result = []
+        for batch in batches(models, batch_size):
+            args = []
+            for m in batch:
+                args.extend(m.insert_args())
+            pks = [m.get_value(pk) for m in batch]
+            select_pk, _ = compile_projection(cls, ())
+            async with transaction():
+                rs = await select(compile_find_many(select_pk, pk, len(pks)) + backend.lock_clause, pks)
+                await execute(compile_upsert(backend, cls.__insert__, pk, tuple(cls.__fields__), len(batch)), args)
+            existing = {r[pk] for r in rs}
+            for key in pks:
+                # 同一批中重复的主键，后面的行是更新
+                result.append(key not in existing)
+                existing.add(key)
+            cls.invalidate(*pks)
+            for m in batch:
+                object.__setattr__(m, '_dirty', ())
+        return result
+
     async def remove(self):
         args = [self.get_value(self.__primary_key__)]
         rows = await execute(self.__delete__, args)
+        self.invalidate(args[0])
         if rows != 1:
             logging.warning('failed to remove by primary key: affected rows: %s' % rows)
 
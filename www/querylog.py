@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+"""
+慢查询日志
+
+原来orm.log()对每条SQL都在INFO级别格式化输出一次，负载高时白白占用事件循环，也看不出哪些查询慢。
+install()把observe()注册到metrics.Registry，之后每条语句结束时都会调用：
+耗时超过slow秒的语句记到有界的环形缓冲区（最多capacity条），并输出WARNING日志；
+其余语句按sample的比例抽样输出INFO日志，默认不输出。
+缓冲区和日志中只有归一化的SQL模板（metrics.normalize()，字面量换成?）和脱敏的参数，直接拼进SQL的值也不会被记录。
+app.init按configs.querylog调用configure()和install()，/admin/queries输出缓冲区中的慢查询。
+"""
+import collections, logging, random, time
+
+import metrics
+
+
+def redact(args):
+    """
+    参数脱敏：只保留类型和长度，不保留值
+    :param args: ``tuple`` or ``list`` SQL参数
+    :return: ``list`` 例如['<str:12>', '<int>', None]
+    """
+    result = []
+    for a in args or ():
+        if a is None:
+            result.append(None)
+        elif isinstance(a, (str, bytes)):
+            result.append('<%s:%d>' % (type(a).__name__, len(a)))
+        else:
+            result.append('<%s>' % type(a).__name__)
+    return result
+
+
+class QueryLog(object):
+
+    def __init__(self, slow=0.1, sample=0.0, capacity=200):
+        """
+        :param slow: ``float`` 慢查询的阈值（秒）
+        :param sample: ``float`` 其余语句输出日志的比例，0~1
+        :param capacity: ``int`` 环形缓冲区保存的慢查询条数
+        """
+        self.slow = slow
+        self.sample = sample
+        self.entries = collections.deque(maxlen=capacity)
+
+    def configure(self, slow=None, sample=None, capacity=None):
+        if slow is not None:
+            self.slow = slow
+        if sample is not None:
+            self.sample = sample
+        if capacity is not None and capacity != self.entries.maxlen:
+            self.entries = collections.deque(self.entries, maxlen=capacity)
+
+    def observe(self, sql, args, seconds, rows, error):
+        """
+        :param sql: ``str`` SQL语句，只记录归一化的模板
+        :param args: SQL参数，只记录脱敏后的结果
+        :param seconds: ``float`` 耗时
+        :param rows: ``int`` 返回或影响的行数
+        :param error: ``bool`` 是否出错
+        """
+        if seconds >= self.slow:
+            sql = metrics.normalize(sql)
+            self.entries.append(dict(time=time.time(), sql=sql, args=redact(args), seconds=seconds, rows=rows,
+                                     error=error))
+            logging.warning('slow query %.3fs rows=%s: %s' % (seconds, rows, sql))
+        elif self.sample and random.random() < self.sample:
+            logging.info('query %.3fs rows=%s: %s %s' % (seconds, rows, metrics.normalize(sql), redact(args)))
+
+    def dump(self):
+        """
+        :return: ``list`` of ``dict`` 缓冲区中的慢查询，最近的在前
+        """
+        return list(reversed(self.entries))
+
+    def clear(self):
+        self.entries.clear()
+
+
+querylog = QueryLog()
+
+
+def configure(**kw):
+    """
+    :param kw: slow、sample、capacity，见QueryLog
+    """
+    querylog.configure(**kw)
+
+
+def install(registry=None):
+    """
+    把querylog.observe注册到metrics.Registry的hooks，重复调用只注册一次
+    :param registry: ``metrics.Registry`` 默认为metrics.registry
+    """
+    registry = registry or metrics.registry
+    if querylog.observe not in registry.hooks:
+        registry.hooks.append(querylog.observe)
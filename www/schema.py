@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+"""
+索引检查和迁移
+
+Model在字段上用index=True、unique=True，或者在__indexes__中用Index声明索引，orm.create_tables()建表时会创建。
+对已经存在的表，check()对比声明的索引和数据库中实际的索引，并根据orm.query_shapes中记录的查询形状
+（WHERE和ORDER BY用到的字段）找出没有索引可用的查询，migration()生成补建索引的语句。
+
+运行：python schema.py [--apply]，按configs.db连接数据库，打印检查结果；--apply时执行补建索引的语句
+"""
+import asyncio, logging, re, sys
+
+import orm
+
+_table = re.compile(r'\sfrom\s+`?(\w+)`?', re.IGNORECASE)
+_identifier = re.compile(r'`?(\w+)`?')
+
+
+async def live_indexes(model):
+    """
+    读取数据库中表上已有的索引，不包括主键
+    :param model: Model的子类
+    :return: ``list`` of ``Index``
+    """
+    sql = orm.current_backend().index_sql
+    if sql is None:
+        return []
+    columns, unique = dict(), dict()
+    for r in await orm.select(sql, (model.__table__,)):
+        name = r['INDEX_NAME']
+        if name == 'PRIMARY' or name.startswith('sqlite_autoindex_'):
+            continue
+        columns.setdefault(name, []).append(r['COLUMN_NAME'])
+        unique[name] = not r['NON_UNIQUE']
+    return [orm.Index(*cols, unique=unique[name], name=name) for name, cols in columns.items()]
+
+
+def missing_indexes(model, live):
+    """
+    :param model: Model的子类
+    :param live: ``list`` of ``Index`` 数据库中已有的索引
+    :return: ``list`` of ``Index`` 声明了但数据库中没有的索引，按字段和是否唯一比较，不比较名称
+    """
+    live = set(live)
+    return [index for index in model.__indexes__ if index not in live]
+
+
+def migration(model, live):
+    """
+    :return: ``list`` of ``str`` 补建缺少的索引的语句
+    """
+    return [model.index_ddl(index) for index in missing_indexes(model, live)]
+
+
+def shape_columns(model, clause):
+    """
+    :param clause: ``str`` WHERE或ORDER BY子句
+    :return: ``list`` 子句中按出现顺序的字段名
+    """
+    if not clause:
+        return []
+    mappings = model.__mappings__
+    seen = []
+    for name in _identifier.findall(clause):
+        if name in mappings and name not in seen:
+            seen.append(name)
+    return seen
+
+
+def uncovered_shapes(model, indexes):
+    """
+    找出orm.query_shapes中查询这个表、但没有索引可用的查询形状。
+    索引（包括主键）的第一个字段出现在WHERE中，或者没有WHERE时是ORDER BY的第一个字段，就认为查询可以用上索引
+    :param model: Model的子类
+    :param indexes: ``list`` of ``Index`` 数据库中已有的索引
+    :return: ``list`` of (where, orderby, 建议的Index)
+    """
+    leading = {index.columns[0] for index in indexes}
+    leading.add(model.__primary_key__)
+    result = []
+    for select, where, orderby in sorted(orm.query_shapes, key=str):
+        m = _table.search(select)
+        if m is None or m.group(1) != model.__table__:
+            continue
+        where_columns = shape_columns(model, where)
+        order_columns = shape_columns(model, orderby)
+        if where_columns:
+            if leading.intersection(where_columns):
+                continue
+            suggested = where_columns + [c for c in order_columns[:1] if c not in where_columns]
+        elif order_columns:
+            if order_columns[0] in leading:
+                continue
+            suggested = order_columns[:1]
+        else:
+            continue
+        result.append((where, orderby, orm.Index(*suggested).bind(model.__table__)))
+    return result
+
+
+async def check(*models):
+    """
+    检查模型的索引
+    :param models: Model的子类
+    :return: ``dict`` 表名 -> dict(missing=缺少的索引, uncovered=没有索引可用的查询形状, migration=补建索引的语句)
+    """
+    report = dict()
+    for model in models:
+        live = await live_indexes(model)
+        report[model.__table__] = dict(
+            missing=missing_indexes(model, live),
+            uncovered=uncovered_shapes(model, live + list(model.__indexes__)),
+            migration=migration(model, live)
+        )
+    return report
+
+
+def format_report(report):
+    """
+    :return: ``str`` 可读的检查结果
+    """
+    lines = []
+    for table, r in sorted(report.items()):
+        lines.append('%s:' % table)
+        for index in r['missing']:
+            lines.append('  missing %s' % index)
+        for where, orderby, index in r['uncovered']:
+            lines.append('  no index for where %r order by %r, consider %s' % (where, orderby, index))
+        if not r['missing'] and not r['uncovered']:
+            lines.append('  ok')
+    return '\n'.join(lines)
+
+
+async def migrate(*models):
+    """
+    执行补建索引的语句
+    :return: ``list`` of ``str`` 执行过的语句
+    """
+    executed = []
+    for model in models:
+        for sql in migration(model, await live_indexes(model)):
+            logging.info('migrate: %s' % sql)
+            await orm.execute(sql, ())
+            executed.append(sql)
+    return executed
+
+
+async def main(loop, apply=False):
+    from config import configs
+    from models import User, Blog, Comment
+    await orm.create_pool(loop=loop, **configs.db)
+    try:
+        print(format_report(await check(User, Blog, Comment)))
+        if apply:
+            for sql in await migrate(User, Blog, Comment):
+                print(sql)
+    finally:
+        await orm.close_pool()
+
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(loop, '--apply' in sys.argv[1:]))
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+"""
+response_factory条件请求的测试：ETag、Last-Modified、If-None-Match、If-Modified-Since和304。
+请求用aiohttp的make_mocked_request构造，直接调用middleware，不经过路由和网络。
+运行：python -m unittest test_app 或 python -m pytest test_app.py
+"""
+import json, unittest, warnings
+from email.utils import formatdate
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+import app
+from coroweb import make_etag, not_modified
+from models import Blog
+
+MODIFIED = 1700000000
+
+
+async def respond(result, method='GET', headers=None):
+    """
+    :param result: URL函数的返回值，每次调用都重新生成（response_factory会修改dict）
+    :return: response_factory生成的响应
+    """
+    async def handler(request):
+        return result() if callable(result) else result
+
+    response = await app.response_factory(None, handler)
+    return await response(make_mocked_request(method, '/', headers=headers or {}))
+
+
+class ETagTest(unittest.IsolatedAsyncioTestCase):
+
+    async def etag(self):
+        resp = await respond(dict(a=1))
+        self.assertEqual(resp.status, 200)
+        return resp.headers['ETag']
+
+    async def test_strong_etag_from_body(self):
+        etag = await self.etag()
+        self.assertRegex(etag, r'^"[0-9a-f]{24}"$')
+        self.assertEqual(etag, await self.etag())
+        other = await respond(dict(a=2))
+        self.assertNotEqual(other.headers['ETag'], etag)
+
+    async def test_if_none_match(self):
+        etag = await self.etag()
+        resp = await respond(dict(a=1), headers={'If-None-Match': etag})
+        self.assertEqual(resp.status, 304)
+        self.assertEqual(resp.headers['ETag'], etag)
+        self.assertFalse(resp.body)
+
+    async def test_if_none_match_weak_list_and_star(self):
+        etag = await self.etag()
+        for value in ('W/' + etag, '"other", %s' % etag, '*'):
+            resp = await respond(dict(a=1), headers={'If-None-Match': value})
+            self.assertEqual(resp.status, 304, value)
+        resp = await respond(dict(a=1), headers={'If-None-Match': '"other"'})
+        self.assertEqual(resp.status, 200)
+
+    async def test_head(self):
+        etag = await self.etag()
+        resp = await respond(dict(a=1), 'HEAD', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status, 304)
+
+    async def test_other_methods_are_not_conditional(self):
+        resp = await respond(dict(a=1), 'POST', headers={'If-None-Match': '*'})
+        self.assertEqual(resp.status, 200)
+        self.assertNotIn('ETag', resp.headers)
+
+    async def test_non_200_responses_have_no_etag(self):
+        for result, status in ((404, 404), ('redirect:/signin', 302), ((500, 'oops'), 500)):
+            resp = await respond(result, headers={'If-None-Match': '*'})
+            self.assertEqual(resp.status, status)
+            self.assertNotIn('ETag', resp.headers)
+
+    async def test_stream_response_is_passed_through(self):
+        original = web.Response(text='as is')
+        resp = await respond(original, headers={'If-None-Match': '*'})
+        self.assertIs(resp, original)
+        self.assertNotIn('ETag', resp.headers)
+
+
+class JSONTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_compact_rows_are_objects(self):
+        row = Blog.__row__._make(('id', 'name'), ('b1', 'first'))
+        resp = await respond(lambda: dict(blogs=[row]))
+        self.assertEqual(json.loads(resp.text)['blogs'][0]['name'], 'first')
+
+
+class ValidatorTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_handler_etag_skips_rendering(self):
+        request = make_mocked_request('GET', '/')
+        etag = make_etag(request, 5)
+        # 命中时不渲染模板：这里没有配置jinja2，渲染会出错
+        resp = await respond(lambda: dict(__template__='blogs.html', __etag__=5), headers={'If-None-Match': etag})
+        self.assertEqual(resp.status, 304)
+        self.assertEqual(resp.headers['ETag'], etag)
+
+    async def test_handler_etag_on_full_response(self):
+        resp = await respond(lambda: dict(a=1, __etag__=5, __last_modified__=MODIFIED))
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(resp.headers['ETag'], make_etag(make_mocked_request('GET', '/'), 5))
+        self.assertEqual(resp.headers['Last-Modified'], formatdate(MODIFIED, usegmt=True))
+        self.assertEqual(resp.text, '{"a": 1}')
+
+    async def test_if_modified_since(self):
+        result = lambda: dict(a=1, __last_modified__=MODIFIED)
+        resp = await respond(result, headers={'If-Modified-Since': formatdate(MODIFIED, usegmt=True)})
+        self.assertEqual(resp.status, 304)
+        resp = await respond(result, headers={'If-Modified-Since': formatdate(MODIFIED - 60, usegmt=True)})
+        self.assertEqual(resp.status, 200)
+
+    async def test_if_none_match_wins_over_if_modified_since(self):
+        resp = await respond(lambda: dict(a=1, __etag__=5, __last_modified__=MODIFIED), headers={
+            'If-None-Match': '"other"', 'If-Modified-Since': formatdate(MODIFIED, usegmt=True)})
+        self.assertEqual(resp.status, 200)
+
+    async def test_etag_depends_on_user(self):
+        anonymous = make_mocked_request('GET', '/')
+        user = make_mocked_request('GET', '/')
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', DeprecationWarning)
+            setattr(user, '__user__', dict(id='u1'))
+        self.assertNotEqual(make_etag(anonymous, 5), make_etag(user, 5))
+
+    def test_not_modified(self):
+        etag = make_etag(make_mocked_request('GET', '/'), 5)
+        resp = not_modified(make_mocked_request('GET', '/', headers={'If-None-Match': etag}), 5)
+        self.assertEqual((resp.status, resp.headers['ETag']), (304, etag))
+        self.assertIsNone(not_modified(make_mocked_request('GET', '/'), 5))
+        self.assertIsNone(not_modified(make_mocked_request('POST', '/', headers={'If-None-Match': etag}), 5))
+
+
+if __name__ == '__main__':
+    unittest.main()
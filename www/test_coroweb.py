@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+"""
+RequestHandler取参数的测试：compile_binder()生成的函数从查询字符串、JSON或form请求体、路由的可变字段中取参数，
+参数有误时返回400；URL函数抛出的HTTP异常和DeadlineExceeded交给middleware处理。
+请求对象用bench_coroweb.FakeRequest，不经过aiohttp的路由和网络。
+运行：python -m unittest test_coroweb 或 python -m pytest test_coroweb.py
+"""
+import unittest
+
+from aiohttp import web
+
+import orm
+from bench_coroweb import FakeRequest
+from coroweb import get, post, RequestHandler
+
+
+class JSONRequest(FakeRequest):
+    """ 请求体原样作为request.json()的结果，可以不是dict """
+
+    async def json(self):
+        return self._body
+
+
+@get('/api/blogs')
+async def api_blogs(*, page='1', size='10'):
+    return dict(page=page, size=size)
+
+
+@get('/api/search')
+async def api_search(**kw):
+    return kw
+
+
+@get('/blog/{id}')
+async def blog(id, request, *, q=None):
+    return dict(id=id, q=q, request=request)
+
+
+@post('/api/users')
+async def api_register_user(*, email, name, passwd='x'):
+    return dict(email=email, name=name, passwd=passwd)
+
+
+@get('/missing')
+async def missing():
+    raise web.HTTPNotFound()
+
+
+@get('/slow')
+async def slow():
+    raise orm.DeadlineExceeded('query deadline exceeded')
+
+
+@get('/broken')
+def broken():
+    raise ValueError('broken')
+
+
+async def call(fn, request):
+    return await RequestHandler(None, fn)(request)
+
+
+class BinderTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_query_first_value_and_named_only(self):
+        r = await call(api_blogs, FakeRequest(query_string='page=2&page=3&other=1'))
+        self.assertEqual(r, dict(page='2', size='10'))
+
+    async def test_query_keeps_blank_values(self):
+        r = await call(api_blogs, FakeRequest(query_string='page=&size=5'))
+        self.assertEqual(r, dict(page='', size='5'))
+
+    async def test_var_kw_receives_all_query_args(self):
+        r = await call(api_search, FakeRequest(query_string='q=python&page=2'))
+        self.assertEqual(r, dict(q='python', page='2'))
+
+    async def test_match_info_and_request(self):
+        request = FakeRequest(query_string='q=a&id=query', match_info={'id': '42'})
+        r = await call(blog, request)
+        # 路由中的可变字段覆盖查询字符串中的同名参数
+        self.assertEqual((r['id'], r['q']), ('42', 'a'))
+        self.assertIs(r['request'], request)
+
+    async def test_match_info_without_query(self):
+        r = await call(blog, FakeRequest(match_info={'id': '42'}))
+        self.assertEqual((r['id'], r['q']), ('42', None))
+
+    async def test_json_body(self):
+        r = await call(api_register_user, FakeRequest(
+            'POST', content_type='application/json', body={'email': 'a@example.com', 'name': 'a', 'extra': 1}))
+        self.assertEqual(r, dict(email='a@example.com', name='a', passwd='x'))
+
+    async def test_form_body(self):
+        r = await call(api_register_user, FakeRequest(
+            'POST', content_type='application/x-www-form-urlencoded',
+            body={'email': 'a@example.com', 'name': 'a', 'passwd': 'p'}))
+        self.assertEqual(r, dict(email='a@example.com', name='a', passwd='p'))
+
+    async def test_missing_required_argument(self):
+        r = await call(api_register_user, FakeRequest(
+            'POST', content_type='application/json', body={'email': 'a@example.com'}))
+        self.assertIsInstance(r, web.HTTPBadRequest)
+        self.assertEqual(r.text, 'Missing argument: name')
+
+    async def test_bad_body(self):
+        r = await call(api_register_user, FakeRequest('POST', body={}))
+        self.assertEqual((r.status, r.text), (400, 'Missing Content-Type.'))
+        r = await call(api_register_user, FakeRequest('POST', content_type='text/plain', body={}))
+        self.assertEqual((r.status, r.text), (400, 'Unsupported Content-Type: text/plain'))
+        r = await call(api_register_user, JSONRequest('POST', content_type='application/json', body=[1]))
+        self.assertEqual(r.status, 400)
+
+
+class HandlerErrorTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_http_exception_is_raised(self):
+        with self.assertRaises(web.HTTPNotFound):
+            await call(missing, FakeRequest())
+
+    async def test_deadline_exceeded_is_raised(self):
+        with self.assertRaises(orm.DeadlineExceeded):
+            await call(slow, FakeRequest())
+
+    async def test_other_exceptions_become_error_dict(self):
+        r = await call(broken, FakeRequest())
+        self.assertIsInstance(r['error'], ValueError)
+
+
+if __name__ == '__main__':
+    unittest.main()
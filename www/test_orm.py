@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+
+"""
+orm的回归测试，使用SQLite后端，不需要MySQL。
+运行：python -m unittest test_orm 或 python -m pytest test_orm.py
+"""
+import asyncio, os, shutil, tempfile, unittest
+
+import orm
+from orm import Model, StringField, FloatField, WriteBehind
+from models import Blog, User
+
+
+class QueuedLog(Model):
+    __table__ = 'queued_logs'
+    __write_behind__ = WriteBehind(max_batch=10, interval=0.01)
+
+    id = StringField(primary_key=True, ddl='varchar(50)')
+    message = StringField(ddl='varchar(50)')
+    created_at = FloatField(default=0.0)
+
+
+def new_blog(**kw):
+    fields = dict(user_id='u1', user_name='n', user_image='i', name='x', summary='s', content='c')
+    fields.update(kw)
+    return Blog(**fields)
+
+
+class SQLiteTestCase(unittest.IsolatedAsyncioTestCase):
+    """ 每个测试使用一个临时的SQLite数据库文件，连接池有多个连接，并发的语句会交错执行 """
+
+    models = (Blog,)
+
+    async def asyncSetUp(self):
+        self.dir = tempfile.mkdtemp()
+        await orm.create_pool(loop=asyncio.get_running_loop(), backend='sqlite',
+                              db=os.path.join(self.dir, 'test.db'))
+        await orm.create_tables(*self.models)
+
+    async def asyncTearDown(self):
+        await orm.close_pool()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+class TableVersionTest(SQLiteTestCase):
+
+    async def test_count_racing_insert_is_not_cached(self):
+        # 和INSERT并发的findNumber()可能读到插入前的计数，不能按插入后的版本号缓存
+        for i in range(50):
+            await asyncio.gather(new_blog().save(), Blog.findNumber('count(id)'))
+            self.assertEqual(await Blog.findNumber('count(id)'), i + 1)
+
+    async def test_version_bumped_after_statement(self):
+        before = orm.table_version(Blog.__table__)
+        await new_blog().save()
+        self.assertEqual(orm.table_version(Blog.__table__), before + 2)
+
+    async def test_version_bumped_after_commit(self):
+        before = orm.table_version(Blog.__table__)
+        async with orm.transaction():
+            await new_blog().save()
+            self.assertEqual(orm.table_version(Blog.__table__), before + 1)
+        self.assertEqual(orm.table_version(Blog.__table__), before + 2)
+
+
+class BatchLoaderTest(SQLiteTestCase):
+
+    async def test_find_matches_sql_equality(self):
+        # 主键是varchar，SQL中 '123' = 123，批量加载和直接查询的结果应当相同
+        await new_blog(id='123').save()
+        self.assertEqual((await Blog.find(123)).id, '123')
+        found = await asyncio.gather(Blog.find(123), Blog.find('123'), Blog.find('missing'))
+        self.assertEqual([b.id if b else None for b in found], ['123', '123', None])
+
+
+class PreparedQueryTest(SQLiteTestCase):
+
+    async def test_prepared_query_binds_args(self):
+        for i in range(3):
+            await new_blog(id='b%d' % i, user_id='u%d' % (i % 2), created_at=float(i)).save()
+        prepared = Blog.where(Blog.user_id == '').order_by(Blog.created_at.desc()).limit(0, 10).prepare()
+        self.assertEqual(await prepared.all(), [])
+        self.assertEqual([b.id for b in await prepared.all('u0', 0, 10)], ['b2', 'b0'])
+        self.assertEqual([b.id for b in await prepared.all('u1', 0, 10, compact=True)], ['b1'])
+        with self.assertRaises(ValueError):
+            await prepared.all('u0')
+
+
+class CacheTest(SQLiteTestCase):
+
+    models = (User,)
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        User.__cache__.clear()
+
+    async def test_loosely_equal_pk_is_invalidated(self):
+        # SQL中 '123' = 123，find(123)查到的行和update()失效的主键'123'必须对应同一个缓存条目
+        await User(id='123', email='a@example.com', passwd='p', name='old', image='i').save()
+        user = await User.find(123)
+        self.assertEqual((user.id, (await User.find(123)).name), ('123', 'old'))
+        user.name = 'new'
+        await user.update()
+        self.assertEqual((await User.find(123)).name, 'new')
+        self.assertEqual((await User.find('123')).name, 'new')
+
+    async def test_cached_row_is_returned_for_exact_pk_only(self):
+        await User(id='abc', email='a@example.com', passwd='p', name='a', image='i').save()
+        self.assertEqual((await User.find('abc')).name, 'a')
+        self.assertEqual(User.__cache__.stats()['size'], 1)
+        # SQLite默认的排序规则区分大小写，'ABC'不能命中'abc'的缓存条目
+        self.assertIsNone(await User.find('ABC'))
+        self.assertEqual((await User.find('abc')).name, 'a')
+
+
+class ReplicaTest(unittest.IsolatedAsyncioTestCase):
+    """ 副本是主库在写入前的一份拷贝，从副本读到的总是旧数据 """
+
+    async def asyncSetUp(self):
+        self.dir = tempfile.mkdtemp()
+        primary, replica = os.path.join(self.dir, 'primary.db'), os.path.join(self.dir, 'replica.db')
+        loop = asyncio.get_running_loop()
+        await orm.create_pool(loop=loop, backend='sqlite', db=primary)
+        await orm.create_tables(User)
+        await User(id='u1', email='a@example.com', passwd='p', name='old', image='i').save()
+        await orm.close_pool()
+        shutil.copy(primary, replica)
+        await orm.create_pool(loop=loop, backend='sqlite', db=primary, replicas=[dict(db=replica)], replica_lag=60)
+        User.__cache__.clear()
+
+    async def asyncTearDown(self):
+        await orm.close_pool()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    async def test_stale_replica_row_is_not_cached_after_write(self):
+        user = await User.find('u1')
+        user.name = 'new'
+        await asyncio.create_task(user.update())
+        # 不在同一个请求中，从副本读到旧数据；写表后replica_lag秒内不放进缓存
+        self.assertEqual((await User.find('u1')).name, 'old')
+        self.assertEqual(User.__cache__.stats()['size'], 0)
+
+    async def test_write_in_child_task_pins_request(self):
+        with orm.request_scope():
+            self.assertEqual((await User.find('u1')).name, 'old')
+            # 绕过Model直接写，缓存中仍是副本上的旧行
+            await asyncio.gather(orm.execute('update `users` set `name`=? where `id`=?', ['new', 'u1']))
+            self.assertTrue(orm.pinned_to_primary())
+            self.assertEqual((await User.find('u1')).name, 'new')
+        self.assertFalse(orm.pinned_to_primary())
+
+
+class BatchDeadlineTest(unittest.IsolatedAsyncioTestCase):
+    """ 用一个很慢的select()代替数据库，记录批量查询看到的截止时间，以及它是否被取消 """
+
+    async def asyncSetUp(self):
+        self.timeouts = []
+        self.cancelled = asyncio.Event()
+        self.select, orm.select = orm.select, self.slow_select
+
+    async def asyncTearDown(self):
+        orm.select = self.select
+
+    async def slow_select(self, sql, args, size=None, kind=None):
+        self.timeouts.append(orm.remaining())
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            self.cancelled.set()
+            raise
+        return []
+
+    async def find(self, pk, seconds):
+        with orm.deadline(seconds):
+            return await Blog.find(pk)
+
+    async def test_batch_is_cancelled_when_all_waiters_give_up(self):
+        with self.assertRaises(orm.DeadlineExceeded):
+            await self.find('a', 0.1)
+        await asyncio.wait_for(self.cancelled.wait(), 0.5)
+        self.assertLessEqual(self.timeouts[0], 0.1)
+
+    async def test_batch_uses_latest_deadline(self):
+        results = await asyncio.gather(self.find('a', 0.05), self.find('b', 0.3), return_exceptions=True)
+        self.assertTrue(all(isinstance(r, orm.DeadlineExceeded) for r in results))
+        self.assertEqual(len(self.timeouts), 1)
+        self.assertGreater(self.timeouts[0], 0.1)
+        await asyncio.wait_for(self.cancelled.wait(), 0.5)
+
+
+class StreamingTest(SQLiteTestCase):
+
+    async def test_statement_while_streaming_in_transaction(self):
+        await new_blog().save()
+
+        async def update_while_iterating():
+            async with orm.transaction():
+                async for b in Blog.iter_all():
+                    b.name = 'y'
+                    await b.update()
+
+        with self.assertRaises(RuntimeError):
+            await asyncio.wait_for(update_while_iterating(), 5)
+        # 迭代结束后同一个事务中可以继续执行语句
+        async with orm.transaction():
+            blogs = [b async for b in Blog.iter_all()]
+            for b in blogs:
+                b.name = 'z'
+                await b.update()
+        self.assertEqual((await Blog.find(blogs[0].id)).name, 'z')
+
+
+class WriteBehindTest(SQLiteTestCase):
+
+    models = (QueuedLog,)
+
+    async def test_failed_insert_is_reported_to_waiter(self):
+        self.assertTrue((await QueuedLog(id='a', message='m').save(wait=True)).result())
+        with self.assertRaises(Exception):
+            await QueuedLog(id='a', message='m').save(wait=True)
+
+    async def test_failed_insert_without_waiter_is_retrieved(self):
+        await QueuedLog(id='a', message='m').save(wait=True)
+        future = await QueuedLog(id='a', message='m').save()
+        await orm.flush_writes()
+        self.assertIsNotNone(future.exception())
+        self.assertFalse(future._log_traceback)
+
+
+class RelationTest(SQLiteTestCase):
+
+    models = (Blog, User)
+
+    async def test_prefetch_loads_declared_columns_only(self):
+        user = User(email='a@example.com', passwd='secret', name='a', image='i')
+        await user.save()
+        await new_blog(user_id=user.id).save()
+        blog = (await Blog.findall(prefetch=['user']))[0]
+        self.assertEqual(blog.user.name, 'a')
+        self.assertNotIn('passwd', blog.user)
+        self.assertNotIn('email', blog.user)
+
+
+class RowTest(SQLiteTestCase):
+
+    async def test_compact_rows(self):
+        await new_blog(id='b1', name='first').save()
+        full = (await Blog.findall(compact=True))[0]
+        self.assertIsInstance(full, orm.Row)
+        self.assertEqual((full.id, full.name, full['name'], full.get('missing', 1)), ('b1', 'first', 'first', 1))
+        # content是延迟加载的字段，没有查询时为None
+        self.assertIsNone(full.content)
+        projected = (await Blog.findall(columns=['name'], compact=True))[0]
+        self.assertEqual(projected._asdict(), dict(full._asdict(), user_id=None, user_name=None, user_image=None,
+                                                   summary=None, created_at=None))
+        with self.assertRaises(AttributeError):
+            full.name = 'x'
+        with self.assertRaises(KeyError):
+            full['missing']
+
+
+if __name__ == '__main__':
+    unittest.main()
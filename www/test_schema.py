@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+"""
+schema的回归测试，使用SQLite后端
+运行：python -m unittest test_schema 或 python -m pytest test_schema.py
+"""
+import unittest
+
+import orm
+import schema
+from models import Blog, Comment
+from test_orm import SQLiteTestCase, new_blog
+
+
+class CheckTest(SQLiteTestCase):
+
+    models = (Blog, Comment)
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        # 形状只在compile_select()的缓存未命中时记录，两者一起清空，结果才和其他测试的执行顺序无关
+        orm.query_shapes.clear()
+        orm.compile_select.cache_clear()
+        await new_blog().save()
+        await new_blog().save()
+
+    async def test_builder_shapes(self):
+        await Blog.where(Blog.user_id == 'u1').order_by(Blog.created_at).all()
+        await Comment.where(Comment.user_id == 'u1').all()
+        report = await schema.check(Blog, Comment)
+        self.assertEqual(report['blogs']['uncovered'], [])
+        uncovered = report['comments']['uncovered']
+        self.assertEqual(len(uncovered), 1)
+        self.assertEqual(uncovered[0][2].columns, ('user_id',))
+        self.assertIn('comments:', schema.format_report(report))
+
+    async def test_findpage_shapes(self):
+        blogs, token = await Blog.findpage('user_id=?', ['u1'], size=1)
+        self.assertIsNotNone(token)
+        await Blog.findpage('user_id=?', ['u1'], token=token, size=1)
+        report = await schema.check(Blog)
+        self.assertEqual(report['blogs']['missing'], [])
+        self.assertEqual(report['blogs']['uncovered'], [])
+
+
+if __name__ == '__main__':
+    unittest.main()